@@ -0,0 +1,322 @@
+"""Benchmark the CPU post-processing steps of the parts pipeline on synthetic sprite sheets.
+
+Times the steps of estimate_foreground_mask_from_edges against the implementations they
+replaced, checks that both produce the same mask, and reports the speedup per size:
+
+- flood fill: the run-based border fill against the original pixel-by-pixel BFS, on the sheet's
+  background and on two winding ones: percolating noise and a serpentine corridor;
+- corner distance: the tiled near-corner-color test against the original broadcast over all
+  four corners, with the peak memory each one allocates;
+- part dedup: select_part_masks on bit-packed proposals against the original loop over full
+  bool masks, with the memory both representations hold.
+
+    python benchmark_postprocess.py
+    python benchmark_postprocess.py --sizes 512 2048 4096 --repeat 5 --json bench.json
+    python benchmark_postprocess.py --proposals 600 --max-regions 40
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import statistics
+import time
+import tracemalloc
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+from PIL import Image
+
+from server import (
+    PackedMask,
+    alpha_opaque_mask,
+    border_connected,
+    estimate_foreground_mask_from_edges,
+    near_corner_colors,
+    select_part_masks,
+    synthetic_sprite,
+)
+
+BACKGROUND = (92, 156, 104)
+# estimate_foreground_mask_from_edges' default channel tolerance of 26, summed over RGB.
+THRESHOLD = 26 * 3
+
+
+def sprite_sheet(size: int, seed: int = 0) -> Image.Image:
+    # An opaque sheet: a 4x4 grid of sprites on a flat background with mild noise, the case the
+    # edge-based foreground estimate exists for.
+    rng = np.random.default_rng(seed)
+    base = np.empty((size, size, 3), dtype=np.int16)
+    base[:] = BACKGROUND
+    base += rng.integers(-6, 7, size=(size, size, 1), dtype=np.int16)
+    sheet = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8), mode="RGB").convert("RGBA")
+    cell = size // 4
+    sprite = synthetic_sprite(cell)
+    for row in range(4):
+        for col in range(4):
+            sheet.alpha_composite(sprite, (col * cell, row * cell))
+    return sheet
+
+
+def noise_background(size: int, density: float = 0.6, seed: int = 0) -> np.ndarray:
+    # A textured background: each pixel is background-colored with the given probability. Above
+    # the ~0.593 site percolation threshold one tangled component spans the image.
+    rng = np.random.default_rng(seed)
+    return rng.random((size, size)) < density
+
+
+def serpentine_background(size: int) -> np.ndarray:
+    # A one-pixel corridor that enters from the top edge and winds back and forth down the
+    # image, so every pixel of it is reached through a single path of about size**2 / 2 steps.
+    mask = np.zeros((size, size), dtype=bool)
+    mask[0 : size - 1 : 2, 1 : size - 1] = True
+    for y in range(1, size - 2, 2):
+        mask[y, size - 2 if (y // 2) % 2 == 0 else 1] = True
+    return mask
+
+
+FLOOD_FILL_CASES: dict[str, Callable[[int], np.ndarray]] = {
+    "sheet": lambda size: near_corner_colors(np.asarray(sprite_sheet(size)), THRESHOLD),
+    "noise": noise_background,
+    "serpentine": serpentine_background,
+}
+
+
+def part_proposals(size: int, count: int, seed: int = 0) -> list[np.ndarray]:
+    # Elliptical part proposals of assorted sizes, with the near-duplicates and nested masks
+    # SAM2 produces for neighbouring grid points.
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    masks: list[np.ndarray] = []
+    while len(masks) < count:
+        cx, cy = rng.uniform(0.1, 0.9, 2) * size
+        rx, ry = rng.uniform(0.01, 0.2, 2) * size
+        mask = ((xx - cx) / rx) ** 2 + ((yy - cy) / ry) ** 2 <= 1.0
+        masks.append(mask)
+        if rng.random() < 0.3:
+            masks.append(np.roll(mask, int(rng.integers(-2, 3)), axis=1))
+        if rng.random() < 0.2:
+            masks.append(mask & (xx < cx + rx * 0.95))
+    return [mask for mask in masks[:count] if mask.any()]
+
+
+def reference_near_corner_colors(rgba: np.ndarray, threshold: int) -> np.ndarray:
+    # The broadcast estimate_foreground_mask_from_edges used before near_corner_colors.
+    rgb = rgba[:, :, :3].astype(np.int16)
+    h, w = rgb.shape[:2]
+    corners = np.stack([rgb[0, 0], rgb[0, w - 1], rgb[h - 1, 0], rgb[h - 1, w - 1]], axis=0)
+    diff = np.abs(rgb[:, :, None, :] - corners[None, None, :, :]).sum(axis=3)
+    return diff.min(axis=2) <= threshold
+
+
+def reference_border_connected(mask: np.ndarray) -> np.ndarray:
+    # The BFS estimate_foreground_mask_from_edges used before the run-based fill.
+    h, w = mask.shape
+    visited = np.zeros((h, w), dtype=bool)
+    q: deque[tuple[int, int]] = deque()
+    for x in range(w):
+        for y in (0, h - 1):
+            if mask[y, x] and not visited[y, x]:
+                visited[y, x] = True
+                q.append((y, x))
+    for y in range(h):
+        for x in (0, w - 1):
+            if mask[y, x] and not visited[y, x]:
+                visited[y, x] = True
+                q.append((y, x))
+    while q:
+        y, x = q.popleft()
+        for ny, nx in ((y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1)):
+            if 0 <= ny < h and 0 <= nx < w and mask[ny, nx] and not visited[ny, nx]:
+                visited[ny, nx] = True
+                q.append((ny, nx))
+    return visited
+
+
+def reference_select_part_masks(masks: list[np.ndarray], min_area: int, max_regions: int) -> list[int]:
+    # The dedup loop build_part_masks ran over full bool masks before PackedMask.
+    order = sorted(range(len(masks)), key=lambda i: int(masks[i].sum()), reverse=True)
+    selected: list[int] = []
+    for i in order:
+        arr = masks[i]
+        area = int(arr.sum())
+        if area < min_area:
+            continue
+        is_duplicate = False
+        for j in selected:
+            existing = masks[j]
+            existing_area = int(existing.sum())
+            inter = int((arr & existing).sum())
+            union = int((arr | existing).sum())
+            iou = float(inter) / float(union)
+            size_ratio = float(area) / float(max(1, existing_area))
+            containment = float(inter) / float(max(1, area))
+            if iou >= 0.92 and 0.8 <= size_ratio <= 1.25:
+                is_duplicate = True
+                break
+            if containment >= 0.985 and size_ratio >= 0.9:
+                is_duplicate = True
+                break
+        if not is_duplicate:
+            selected.append(i)
+            if len(selected) >= max_regions:
+                break
+    return selected
+
+
+def peak_mb(fn: Callable[[], Any]) -> float:
+    # numpy reports its buffers to tracemalloc, so this is the peak of everything fn allocates.
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1e6, 1)
+
+
+def time_ms(fn: Callable[[], Any], repeat: int) -> tuple[float, Any]:
+    runs: list[float] = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        runs.append((time.perf_counter() - started) * 1000.0)
+    return statistics.median(runs), result
+
+
+def bench_flood_fill(case: str, size: int, repeat: int, reference_repeat: int) -> dict[str, Any]:
+    candidate = FLOOD_FILL_CASES[case](size)
+    fill_ms, filled = time_ms(lambda: border_connected(candidate), repeat)
+    reference_ms, expected = time_ms(lambda: reference_border_connected(candidate), reference_repeat)
+    estimate_ms = None
+    if case == "sheet":
+        image = sprite_sheet(size)
+        fallback = alpha_opaque_mask(image)
+        estimate_ms, _ = time_ms(lambda: estimate_foreground_mask_from_edges(image, fallback), repeat)
+        estimate_ms = round(estimate_ms, 2)
+    return {
+        "case": case,
+        "size": size,
+        "identical": bool(np.array_equal(filled, expected)),
+        "background_px": int(expected.sum()),
+        "reference_ms": round(reference_ms, 2),
+        "flood_fill_ms": round(fill_ms, 2),
+        "speedup": round(reference_ms / max(fill_ms, 1e-6), 1),
+        "estimate_ms": estimate_ms,
+    }
+
+
+def bench_corner_distance(size: int, repeat: int) -> dict[str, Any]:
+    rgba = np.asarray(sprite_sheet(size))
+    tiled_ms, tiled = time_ms(lambda: near_corner_colors(rgba, THRESHOLD), repeat)
+    reference_ms, expected = time_ms(lambda: reference_near_corner_colors(rgba, THRESHOLD), repeat)
+    image = Image.fromarray(rgba, mode="RGBA")
+    fallback = alpha_opaque_mask(image)
+    return {
+        "size": size,
+        "identical": bool(np.array_equal(tiled, expected)),
+        "reference_ms": round(reference_ms, 2),
+        "tiled_ms": round(tiled_ms, 2),
+        "reference_peak_mb": peak_mb(lambda: reference_near_corner_colors(rgba, THRESHOLD)),
+        "tiled_peak_mb": peak_mb(lambda: near_corner_colors(rgba, THRESHOLD)),
+        "estimate_peak_mb": peak_mb(lambda: estimate_foreground_mask_from_edges(image, fallback)),
+    }
+
+
+def bench_part_dedup(size: int, proposals: int, max_regions: int, repeat: int) -> dict[str, Any]:
+    masks = part_proposals(size, proposals)
+    packed = [PackedMask.pack(mask) for mask in masks]
+    index = {id(mask): i for i, mask in enumerate(packed)}
+    min_area = 32
+    dedup_ms, selected = time_ms(lambda: select_part_masks(packed, min_area, max_regions), repeat)
+    reference_ms, expected = time_ms(lambda: reference_select_part_masks(masks, min_area, max_regions), 1)
+    return {
+        "size": size,
+        "proposals": len(masks),
+        "selected": len(expected),
+        "identical": [index[id(mask)] for mask in selected] == expected,
+        "reference_ms": round(reference_ms, 2),
+        "dedup_ms": round(dedup_ms, 2),
+        "speedup": round(reference_ms / max(dedup_ms, 1e-6), 1),
+        "bool_mb": round(sum(mask.nbytes for mask in masks) / 1e6, 1),
+        "packed_mb": round(sum(mask.nbytes for mask in packed) / 1e6, 1),
+    }
+
+
+def print_report(
+    rows: list[dict[str, Any]], corner_rows: list[dict[str, Any]], dedup_rows: list[dict[str, Any]]
+) -> None:
+    print("flood fill")
+    header = (
+        f"{'case':>10} {'size':>6} {'identical':>9} {'BFS ms':>10} {'fill ms':>9} {'speedup':>8} "
+        f"{'estimate ms':>12}"
+    )
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        estimate = "-" if row["estimate_ms"] is None else f"{row['estimate_ms']:.1f}"
+        print(
+            f"{row['case']:>10} {row['size']:>6} {str(row['identical']):>9} {row['reference_ms']:>10.1f} "
+            f"{row['flood_fill_ms']:>9.2f} {row['speedup']:>7.1f}x {estimate:>12}"
+        )
+    print("\ncorner distance")
+    header = (
+        f"{'size':>6} {'identical':>9} {'broadcast ms':>13} {'tiled ms':>9} "
+        f"{'broadcast MB':>13} {'tiled MB':>9} {'estimate MB':>12}"
+    )
+    print(header)
+    print("-" * len(header))
+    for row in corner_rows:
+        print(
+            f"{row['size']:>6} {str(row['identical']):>9} {row['reference_ms']:>13.1f} "
+            f"{row['tiled_ms']:>9.1f} {row['reference_peak_mb']:>13.1f} {row['tiled_peak_mb']:>9.1f} "
+            f"{row['estimate_peak_mb']:>12.1f}"
+        )
+    print("\npart dedup")
+    header = (
+        f"{'size':>6} {'masks':>9} {'identical':>9} {'loop ms':>9} {'dedup ms':>10} {'speedup':>8} "
+        f"{'bool MB':>8} {'packed MB':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+    for row in dedup_rows:
+        print(
+            f"{row['size']:>6} {row['selected']:>4}/{row['proposals']:<4} {str(row['identical']):>9} "
+            f"{row['reference_ms']:>9.1f} {row['dedup_ms']:>10.1f} {row['speedup']:>7.1f}x "
+            f"{row['bool_mb']:>8.1f} {row['packed_mb']:>10.1f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512, 1024, 2048])
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per size")
+    parser.add_argument("--reference-repeat", type=int, default=1, help="timed runs of the slow BFS")
+    parser.add_argument("--proposals", type=int, default=300, help="part proposals per dedup run")
+    parser.add_argument("--max-regions", type=int, default=40)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    rows = [
+        bench_flood_fill(case, size, args.repeat, args.reference_repeat)
+        for case in FLOOD_FILL_CASES
+        for size in args.sizes
+    ]
+    corner_rows = [bench_corner_distance(size, args.repeat) for size in args.sizes]
+    dedup_rows = [
+        bench_part_dedup(size, args.proposals, args.max_regions, args.repeat) for size in args.sizes
+    ]
+    print_report(rows, corner_rows, dedup_rows)
+    if args.json:
+        report = {"flood_fill": rows, "corner_distance": corner_rows, "part_dedup": dedup_rows}
+        Path(args.json).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    if not all(row["identical"] for row in rows + corner_rows + dedup_rows):
+        print("[ERROR] An optimized step differs from its reference implementation")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Benchmark a SAM2 model variant against a baseline and report mask agreement.
+
+Runs the server's mask pipeline with both models over a set of images and reports encoder and
+end-to-end latency, weight memory and how closely the candidate masks match the baseline masks.
+The same model at two precisions is compared the same way.
+
+    python compare_models.py --baseline small --candidate small-int8
+    python compare_models.py --baseline small --candidate small --candidate-precision bf16
+    python compare_models.py --candidate small-int8 --images .\\samples --json report.json --min-iou 0.9
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import statistics
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from server import (
+    PRECISIONS,
+    ByteBudgetLRU,
+    ModelRegistry,
+    SegmentRequest,
+    build_generator,
+    decode_proposals,
+    image_from_bytes,
+    pil_to_rgb_numpy,
+    resolve_model_variants,
+    select_proposals,
+    synthetic_sprite,
+)
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+
+
+def load_corpus(images_dir: str | None, sizes: list[int]) -> list[tuple[str, np.ndarray]]:
+    if not images_dir:
+        return [(f"synthetic-{size}", pil_to_rgb_numpy(synthetic_sprite(size))) for size in sizes]
+    paths = sorted(p for p in Path(images_dir).iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    if not paths:
+        raise SystemExit(f"No images found in '{images_dir}'")
+    return [(p.name, pil_to_rgb_numpy(image_from_bytes(p.read_bytes()))) for p in paths]
+
+
+def mask_stack(anns: list[dict[str, Any]], shape: tuple[int, int]) -> np.ndarray:
+    if not anns:
+        return np.zeros((0, shape[0] * shape[1]), dtype=np.float32)
+    return np.stack([a["segmentation"].unpack().ravel() for a in anns]).astype(np.float32)
+
+
+def best_match_ious(reference: np.ndarray, candidate: np.ndarray) -> np.ndarray:
+    # For every reference mask, the IoU of the candidate mask that overlaps it best.
+    if reference.shape[0] == 0:
+        return np.zeros(0, dtype=np.float32)
+    if candidate.shape[0] == 0:
+        return np.zeros(reference.shape[0], dtype=np.float32)
+    intersection = reference @ candidate.T
+    union = reference.sum(axis=1)[:, None] + candidate.sum(axis=1)[None, :] - intersection
+    return (intersection / np.maximum(union, 1.0)).max(axis=1)
+
+
+def union_iou(reference: np.ndarray, candidate: np.ndarray) -> float:
+    a = reference.max(axis=0) > 0 if reference.shape[0] else None
+    b = candidate.max(axis=0) > 0 if candidate.shape[0] else None
+    if a is None or b is None:
+        return 1.0 if a is None and b is None else 0.0
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+def run_pipeline(
+    loaded: Any, req: SegmentRequest, rgb: np.ndarray, precision: str, timings: dict[str, float]
+) -> list[dict[str, Any]]:
+    # The request path without the caches: an empty embedding cache forces an encoder pass.
+    generator = build_generator(loaded.model, req)
+    proposals = decode_proposals(
+        generator,
+        rgb,
+        "compare",
+        ByteBudgetLRU(0),
+        iou_floor=req.pred_iou_thresh,
+        stability_floor=req.stability_score_thresh,
+        timings=timings,
+        precision=precision,
+    )
+    return select_proposals(
+        proposals, req.pred_iou_thresh, req.stability_score_thresh, generator.box_nms_thresh
+    )
+
+
+def time_model(
+    loaded: Any, req: SegmentRequest, rgb: np.ndarray, repeat: int, precision: str
+) -> dict[str, Any]:
+    encode_ms: list[float] = []
+    total_ms: list[float] = []
+    anns: list[dict[str, Any]] = []
+    for _ in range(repeat):
+        timings: dict[str, float] = {}
+        started = time.perf_counter()
+        anns = run_pipeline(loaded, req, rgb, precision, timings)
+        total_ms.append((time.perf_counter() - started) * 1000.0)
+        encode_ms.append(timings["encode_ms"])
+    return {
+        "encode_ms": statistics.median(encode_ms),
+        "total_ms": statistics.median(total_ms),
+        "anns": anns,
+    }
+
+
+def compare(args: argparse.Namespace) -> dict[str, Any]:
+    variants, _ = resolve_model_variants()
+    registry = ModelRegistry(variants, args.baseline, max_bytes=1 << 62)
+    baseline = registry.get(args.baseline)
+    candidate = registry.get(args.candidate)
+    req = SegmentRequest(
+        image="",
+        points_per_side=args.points_per_side,
+        pred_iou_thresh=args.pred_iou_thresh,
+        stability_score_thresh=args.stability_score_thresh,
+        use_m2m=args.use_m2m,
+    )
+    corpus = load_corpus(args.images, args.sizes)
+
+    images: list[dict[str, Any]] = []
+    for name, rgb in corpus:
+        # One untimed pass per model pays for lazy initialisation before measuring.
+        run_pipeline(baseline, req, rgb, args.baseline_precision, {})
+        run_pipeline(candidate, req, rgb, args.candidate_precision, {})
+        ref = time_model(baseline, req, rgb, args.repeat, args.baseline_precision)
+        cand = time_model(candidate, req, rgb, args.repeat, args.candidate_precision)
+
+        ref_masks = mask_stack(ref["anns"], rgb.shape[:2])
+        cand_masks = mask_stack(cand["anns"], rgb.shape[:2])
+        forward = best_match_ious(ref_masks, cand_masks)
+        reverse = best_match_ious(cand_masks, ref_masks)
+        images.append(
+            {
+                "image": name,
+                "width": int(rgb.shape[1]),
+                "height": int(rgb.shape[0]),
+                "baseline_masks": int(ref_masks.shape[0]),
+                "candidate_masks": int(cand_masks.shape[0]),
+                "baseline_encode_ms": round(ref["encode_ms"], 1),
+                "candidate_encode_ms": round(cand["encode_ms"], 1),
+                "baseline_total_ms": round(ref["total_ms"], 1),
+                "candidate_total_ms": round(cand["total_ms"], 1),
+                "mean_best_iou": round(float(forward.mean()) if forward.size else 1.0, 4),
+                "mean_best_iou_reverse": round(float(reverse.mean()) if reverse.size else 1.0, 4),
+                "matched_at_0_9": round(float((forward >= 0.9).mean()) if forward.size else 1.0, 4),
+                "foreground_iou": round(union_iou(ref_masks, cand_masks), 4),
+            }
+        )
+
+    def mean(key: str) -> float:
+        return round(statistics.fmean(row[key] for row in images), 4)
+
+    return {
+        "baseline": {
+            "name": baseline.cfg.name,
+            "precision": args.baseline_precision,
+            "device": baseline.cfg.device,
+            "bytes": baseline.nbytes,
+        },
+        "candidate": {
+            "name": candidate.cfg.name,
+            "precision": args.candidate_precision,
+            "device": candidate.cfg.device,
+            "bytes": candidate.nbytes,
+        },
+        "points_per_side": args.points_per_side,
+        "use_m2m": args.use_m2m,
+        "repeat": args.repeat,
+        "summary": {
+            "encode_speedup": round(mean("baseline_encode_ms") / max(mean("candidate_encode_ms"), 1e-6), 3),
+            "total_speedup": round(mean("baseline_total_ms") / max(mean("candidate_total_ms"), 1e-6), 3),
+            "weight_bytes_ratio": round(candidate.nbytes / max(baseline.nbytes, 1), 3),
+            "mean_best_iou": mean("mean_best_iou"),
+            "mean_best_iou_reverse": mean("mean_best_iou_reverse"),
+            "matched_at_0_9": mean("matched_at_0_9"),
+            "foreground_iou": mean("foreground_iou"),
+        },
+        "images": images,
+    }
+
+
+def print_report(report: dict[str, Any]) -> None:
+    base, cand = report["baseline"], report["candidate"]
+    print(
+        f"baseline  {base['name']} {base['precision']} ({base['device']}, {base['bytes'] / 1e6:.1f} MB)\n"
+        f"candidate {cand['name']} {cand['precision']} ({cand['device']}, {cand['bytes'] / 1e6:.1f} MB)"
+    )
+    header = f"{'image':<24} {'masks':>9} {'encode ms':>17} {'total ms':>17} {'best IoU':>9} {'fg IoU':>7}"
+    print(header)
+    print("-" * len(header))
+    for row in report["images"]:
+        print(
+            f"{row['image'][:24]:<24} "
+            f"{row['baseline_masks']:>4}/{row['candidate_masks']:<4} "
+            f"{row['baseline_encode_ms']:>8.0f}/{row['candidate_encode_ms']:<8.0f} "
+            f"{row['baseline_total_ms']:>8.0f}/{row['candidate_total_ms']:<8.0f} "
+            f"{row['mean_best_iou']:>9.3f} {row['foreground_iou']:>7.3f}"
+        )
+    summary = report["summary"]
+    print(
+        f"\nencoder speedup x{summary['encode_speedup']}, end-to-end speedup x{summary['total_speedup']}, "
+        f"weights x{summary['weight_bytes_ratio']}\n"
+        f"mean best-match IoU {summary['mean_best_iou']} (reverse {summary['mean_best_iou_reverse']}), "
+        f"{summary['matched_at_0_9'] * 100:.1f}% of baseline masks matched at IoU >= 0.9"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--baseline", default="small", help="reference model name (default: small)")
+    parser.add_argument("--candidate", default="small-int8", help="model to compare (default: small-int8)")
+    parser.add_argument("--baseline-precision", choices=PRECISIONS, default="fp32")
+    parser.add_argument("--candidate-precision", choices=PRECISIONS, default="fp32")
+    parser.add_argument("--images", help="directory of sample images; synthetic sprites when omitted")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512], help="synthetic sprite sizes")
+    parser.add_argument("--points-per-side", type=int, default=32)
+    parser.add_argument("--pred-iou-thresh", type=float, default=0.8)
+    parser.add_argument("--stability-score-thresh", type=float, default=0.95)
+    parser.add_argument("--use-m2m", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per image and model")
+    parser.add_argument("--json", help="also write the full report to this file")
+    parser.add_argument(
+        "--min-iou",
+        type=float,
+        help="exit with status 1 when the mean best-match IoU falls below this value",
+    )
+    args = parser.parse_args()
+
+    report = compare(args)
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    if args.min_iou is not None and report["summary"]["mean_best_iou"] < args.min_iou:
+        print(f"[ERROR] Mean best-match IoU {report['summary']['mean_best_iou']} is below {args.min_iou}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,64 +14,95 @@ Body:
   }
 Response:
   image/png mask (white foreground, black background)
+
+The image can also be sent as raw bytes (application/octet-stream or image/*) with the other
+fields in the query string, or as a multipart upload with the fields as form fields.
 """
 
 from __future__ import annotations
 
+import asyncio
 import base64
+import hashlib
+import importlib.metadata
 import inspect
 import io
+import itertools
+import json
 import os
-from collections import deque
-from dataclasses import dataclass
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import AbstractContextManager, asynccontextmanager, nullcontext
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Literal
 
 import numpy as np
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from PIL import Image, ImageDraw
-from pydantic import BaseModel, Field
-
-try:
-    import torch
-except Exception as exc:  # pragma: no cover - runtime environment issue
-    raise RuntimeError("PyTorch is required. Install torch before running this server.") from exc
+from pydantic import BaseModel, Field, ValidationError
+from starlette.concurrency import run_in_threadpool
 
-try:
+if TYPE_CHECKING:
     from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
-    from sam2.build_sam import build_sam2
-except Exception as exc:  # pragma: no cover - runtime environment issue
-    raise RuntimeError(
-        "SAM2 imports failed. Install SAM2 from source in this environment."
-    ) from exc
+    from sam2.utils.amg import MaskData
+
+
+SERVER_VERSION = "1.1.0"
 
 
 class SegmentRequest(BaseModel):
     image: str
+    model: str | None = None
+    precision: Literal["fp32", "bf16"] | None = None
     points_per_side: int = Field(default=32, ge=8, le=128)
     pred_iou_thresh: float = Field(default=0.8, ge=0, le=1)
     stability_score_thresh: float = Field(default=0.95, ge=0, le=1)
     use_m2m: bool = True
+    # Wall-clock budget for the whole request; the run stops at the next checkpoint once it is spent.
+    deadline_ms: int | None = Field(default=None, ge=1)
+    # Output format; when unset it is negotiated from the Accept header (see SEGMENT_FORMATS).
+    format: Literal["png", "packbits", "rle"] | None = None
 
 
 class PartsRequest(SegmentRequest):
     max_regions: int = Field(default=12, ge=4, le=40)
+    format: Literal["json", "labelmap"] | None = None  # type: ignore[assignment]
+
+
+class JobRequest(PartsRequest):
+    kind: Literal["segment", "parts"] = "parts"
+    format: Literal["png", "packbits", "rle", "json", "labelmap"] | None = None  # type: ignore[assignment]
 
 
 @dataclass(frozen=True)
 class Sam2Config:
+    name: str
     config_path: str
     checkpoint_path: str
     device: str
+    quantization: str = "none"
+
+    @property
+    def installed(self) -> bool:
+        return Path(self.config_path).exists() and Path(self.checkpoint_path).exists()
 
 
 def parse_data_url(data_url: str) -> bytes:
     if not data_url.startswith("data:"):
         raise HTTPException(
             status_code=400,
-            detail="Only data URL images are supported (expected data:image/...;base64,...)",
+            detail="Expected a data URL (data:image/...;base64,...); send raw bytes as the request body instead",
         )
     try:
         _, encoded = data_url.split(",", 1)
@@ -83,8 +114,7 @@ def parse_data_url(data_url: str) -> bytes:
         raise HTTPException(status_code=400, detail="Invalid base64 image payload") from exc
 
 
-def image_from_data_url(data_url: str) -> Image.Image:
-    image_bytes = parse_data_url(data_url)
+def image_from_bytes(image_bytes: bytes) -> Image.Image:
     try:
         image = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
     except Exception as exc:
@@ -101,6 +131,8 @@ def pil_to_rgb_numpy(image: Image.Image) -> np.ndarray:
 
 
 def build_generator(model: Any, req: SegmentRequest) -> SAM2AutomaticMaskGenerator:
+    from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+
     signature = inspect.signature(SAM2AutomaticMaskGenerator.__init__)
     supported = set(signature.parameters.keys())
     kwargs: dict[str, Any] = {}
@@ -115,21 +147,880 @@ def build_generator(model: Any, req: SegmentRequest) -> SAM2AutomaticMaskGenerat
     return SAM2AutomaticMaskGenerator(model=model, **kwargs)
 
 
+def env_megabytes(name: str, default_mb: float) -> int:
+    raw = os.environ.get(name, "").strip()
+    if not raw:
+        return int(default_mb * 1024 * 1024)
+    try:
+        return max(0, int(float(raw) * 1024 * 1024))
+    except ValueError:
+        print(f"[WARN] {name} must be a size in megabytes, got '{raw}'. Using {default_mb}.")
+        return int(default_mb * 1024 * 1024)
+
+
+def env_flag(name: str, default: bool) -> bool:
+    raw = os.environ.get(name, "").strip().lower()
+    if not raw:
+        return default
+    return raw in ("1", "true", "yes", "on")
+
+
+def env_float(name: str, default: float) -> float:
+    raw = os.environ.get(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        print(f"[WARN] {name} must be a number, got '{raw}'. Using {default}.")
+        return default
+
+
+def env_int(name: str, default: int) -> int:
+    raw = os.environ.get(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        print(f"[WARN] {name} must be an integer, got '{raw}'. Using {default}.")
+        return default
+
+
+class ByteBudgetLRU:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key: object) -> bool:
+        # Membership only: no LRU touch and no hit/miss accounting.
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: str, value: Any, nbytes: int) -> None:
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+                self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class DiskCache:
+    # SQLite index plus one directory of .npy blobs per entry. Blobs are written to a temp dir and
+    # renamed into place, and SQLite runs in WAL mode, so several server processes can share one
+    # cache directory.
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connect().execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                meta TEXT NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._connect().execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)"
+        )
+        # Blobs whose entry is gone but whose files could not be deleted yet, typically because
+        # another process still has them open on Windows. They count against the size cap until
+        # a later eviction pass manages to delete them.
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS orphans (key TEXT PRIMARY KEY, nbytes INTEGER NOT NULL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.root / "index.sqlite3", timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _entry_dir(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def _count(self, field: str) -> None:
+        with self._stats_lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def __contains__(self, key: object) -> bool:
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=20).hexdigest()
+        try:
+            row = self._connect().execute("SELECT 1 FROM entries WHERE key = ?", (digest,)).fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None
+
+    def get(self, key: str) -> tuple[dict[str, np.ndarray], dict[str, Any]] | None:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=20).hexdigest()
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT meta, nbytes FROM entries WHERE key = ?", (digest,)
+            ).fetchone()
+            if row is None:
+                self._count("misses")
+                return None
+            meta = json.loads(row[0])
+            entry_dir = self._entry_dir(digest)
+            try:
+                arrays = {name: load_npy(entry_dir / f"{name}.npy") for name in meta["arrays"]}
+            except (OSError, ValueError):
+                self._remove(conn, digest, int(row[1]))
+                self._count("misses")
+                return None
+            conn.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), digest)
+            )
+        except sqlite3.Error as exc:
+            print(f"[WARN] Disk cache lookup failed: {exc}")
+            return None
+        self._count("hits")
+        return arrays, meta["info"]
+
+    def put(self, key: str, kind: str, arrays: dict[str, np.ndarray], info: dict[str, Any]) -> None:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=20).hexdigest()
+        entry_dir = self._entry_dir(digest)
+        tmp_dir = entry_dir.with_name(f"{digest}.{os.getpid()}.{threading.get_ident()}.tmp")
+        nbytes = 0
+        try:
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            for name, arr in arrays.items():
+                np.save(tmp_dir / f"{name}.npy", np.ascontiguousarray(arr), allow_pickle=False)
+                nbytes += int(arr.nbytes)
+            # Content is addressed by key, so whichever writer lands last is equivalent.
+            if not delete_dir(entry_dir):
+                raise OSError(f"could not replace '{entry_dir}', it is still in use")
+            os.replace(tmp_dir, entry_dir)
+        except OSError as exc:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            print(f"[WARN] Disk cache write failed: {exc}")
+            return
+
+        meta = json.dumps({"arrays": list(arrays.keys()), "info": info})
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, kind, meta, nbytes, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (digest, kind, meta, nbytes, time.time()),
+            )
+            self._evict(conn)
+        except sqlite3.Error as exc:
+            print(f"[WARN] Disk cache index update failed: {exc}")
+
+    def _remove(self, conn: sqlite3.Connection, digest: str, nbytes: int) -> None:
+        conn.execute("DELETE FROM entries WHERE key = ?", (digest,))
+        if not delete_dir(self._entry_dir(digest)):
+            conn.execute(
+                "INSERT OR REPLACE INTO orphans (key, nbytes) VALUES (?, ?)", (digest, nbytes)
+            )
+
+    def _total_bytes(self, conn: sqlite3.Connection) -> int:
+        return int(
+            conn.execute(
+                "SELECT (SELECT COALESCE(SUM(nbytes), 0) FROM entries)"
+                " + (SELECT COALESCE(SUM(nbytes), 0) FROM orphans)"
+            ).fetchone()[0]
+        )
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        for (digest,) in conn.execute("SELECT key FROM orphans").fetchall():
+            # A put may have reused the key since; its fresh blob is not an orphan.
+            if conn.execute("SELECT 1 FROM entries WHERE key = ?", (digest,)).fetchone() is not None:
+                conn.execute("DELETE FROM orphans WHERE key = ?", (digest,))
+            elif delete_dir(self._entry_dir(digest)):
+                conn.execute("DELETE FROM orphans WHERE key = ?", (digest,))
+        total = self._total_bytes(conn)
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT key, nbytes FROM entries ORDER BY last_access ASC").fetchall()
+        for digest, nbytes in rows:
+            if total <= self.max_bytes:
+                break
+            self._remove(conn, digest, int(nbytes))
+            # Bytes the remove could not free stay in the total through the orphans table.
+            total = self._total_bytes(conn)
+            self._count("evictions")
+
+    def stats(self) -> dict[str, Any]:
+        try:
+            conn = self._connect()
+            entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            orphans = conn.execute("SELECT COUNT(*) FROM orphans").fetchone()[0]
+            total = self._total_bytes(conn)
+        except sqlite3.Error:
+            entries, orphans, total = -1, -1, -1
+        with self._stats_lock:
+            return {
+                "path": str(self.root),
+                "entries": int(entries),
+                "orphans": int(orphans),
+                "bytes": int(total),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def load_npy(path: Path) -> np.ndarray:
+    # Read into memory rather than mapped: cached values outlive the lookup, and on Windows a
+    # mapped file cannot be deleted, which would pin evicted blobs on disk.
+    return np.load(path, allow_pickle=False)
+
+
+def delete_dir(path: Path) -> bool:
+    # False when the directory is still there afterwards, e.g. a file in it is open on Windows.
+    shutil.rmtree(path, ignore_errors=True)
+    return not path.exists()
+
+
+class TieredCache(ByteBudgetLRU):
+    # In-memory LRU in front of an optional shared DiskCache. Values are converted to and from
+    # plain numpy arrays for the disk tier by the encode/decode callables.
+    def __init__(
+        self,
+        max_bytes: int,
+        kind: str,
+        disk: DiskCache | None,
+        encode: Callable[[Any], tuple[dict[str, np.ndarray], dict[str, Any]]],
+        decode: Callable[[dict[str, np.ndarray], dict[str, Any]], tuple[Any, int]],
+    ) -> None:
+        super().__init__(max_bytes)
+        self.kind = kind
+        self.disk = disk
+        self._encode = encode
+        self._decode = decode
+
+    def get(self, key: str) -> Any | None:
+        value = super().get(key)
+        if value is not None or self.disk is None:
+            return value
+        stored = self.disk.get(f"{self.kind}:{key}")
+        if stored is None:
+            return None
+        value, nbytes = self._decode(*stored)
+        super().put(key, value, nbytes)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        if super().__contains__(key):
+            return True
+        return self.disk is not None and f"{self.kind}:{key}" in self.disk
+
+    def put(self, key: str, value: Any, nbytes: int) -> None:
+        super().put(key, value, nbytes)
+        if self.disk is not None:
+            arrays, info = self._encode(value)
+            self.disk.put(f"{self.kind}:{key}", self.kind, arrays, info)
+
+
+def resolve_disk_cache() -> DiskCache | None:
+    cache_dir = os.environ.get("SAM2_DISK_CACHE_DIR", "").strip()
+    if not cache_dir and not env_flag("SAM2_DISK_CACHE", False):
+        return None
+    root = Path(cache_dir) if cache_dir else Path(__file__).resolve().parent / "cache"
+    try:
+        return DiskCache(root, env_megabytes("SAM2_DISK_CACHE_MB", 4096))
+    except (OSError, sqlite3.Error) as exc:
+        print(f"[WARN] Disk cache disabled, could not open '{root}': {exc}")
+        return None
+
+
+def image_digest(rgb: np.ndarray) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(repr(rgb.shape).encode("ascii"))
+    hasher.update(np.ascontiguousarray(rgb).data)
+    return hasher.hexdigest()
+
+
+def feature_nbytes(features: dict[str, Any]) -> int:
+    tensors = [features["image_embed"], *features["high_res_feats"]]
+    return sum(int(t.element_size() * t.nelement()) for t in tensors)
+
+
+def encode_features(features: dict[str, Any]) -> tuple[dict[str, np.ndarray], dict[str, Any]]:
+    tensors = [features["image_embed"], *features["high_res_feats"]]
+    arrays = {f"level_{idx}": t.detach().float().cpu().numpy() for idx, t in enumerate(tensors)}
+    info = {"levels": len(tensors), "dtype": str(tensors[0].dtype).replace("torch.", "")}
+    return arrays, info
+
+
+FeatureDecoder = Callable[[dict[str, np.ndarray], dict[str, Any]], tuple[Any, int]]
+
+
+def feature_decoder(device: str) -> FeatureDecoder:
+    def decode(arrays: dict[str, np.ndarray], info: dict[str, Any]) -> tuple[Any, int]:
+        import torch
+
+        dtype = getattr(torch, info["dtype"])
+        tensors = [
+            torch.from_numpy(np.array(arrays[f"level_{idx}"])).to(device=device, dtype=dtype)
+            for idx in range(int(info["levels"]))
+        ]
+        features = {"image_embed": tensors[0], "high_res_feats": tensors[1:]}
+        return features, feature_nbytes(features)
+
+    return decode
+
+
+def set_image_cached(
+    predictor: Any,
+    rgb: np.ndarray,
+    image_key: str,
+    embedding_cache: ByteBudgetLRU,
+    features: dict[str, Any] | None = None,
+) -> None:
+    # features: an embedding already computed for this image, e.g. by the encoder batcher.
+    if features is not None:
+        embedding_cache.put(image_key, features, feature_nbytes(features))
+    else:
+        features = embedding_cache.get(image_key)
+    if features is None:
+        predictor.set_image(rgb)
+        embedding_cache.put(image_key, predictor._features, feature_nbytes(predictor._features))
+        return
+
+    # Disk entries decode onto the default device; int8 variants always run on the CPU.
+    if features["image_embed"].device != predictor.device:
+        features = {
+            "image_embed": features["image_embed"].to(predictor.device),
+            "high_res_feats": [feat.to(predictor.device) for feat in features["high_res_feats"]],
+        }
+
+    # Same predictor state SAM2ImagePredictor.set_image() leaves behind, minus the encoder pass.
+    predictor.reset_predictor()
+    predictor._orig_hw = [rgb.shape[:2]]
+    predictor._features = features
+    predictor._is_image_set = True
+
+
+@dataclass
+class ProposalSet:
+    # Every mask proposal for one image that clears the floors, before the request thresholds
+    # and NMS. Masks are stored as SAM2 column-major RLE counts, concatenated.
+    height: int
+    width: int
+    iou_preds: np.ndarray
+    stability_scores: np.ndarray
+    points: np.ndarray
+    boxes: np.ndarray
+    rle_counts: np.ndarray
+    rle_offsets: np.ndarray
+    iou_floor: float
+    stability_floor: float
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            int(arr.nbytes)
+            for arr in (
+                self.iou_preds,
+                self.stability_scores,
+                self.points,
+                self.boxes,
+                self.rle_counts,
+                self.rle_offsets,
+            )
+        )
+
+    def covers(self, pred_iou_thresh: float, stability_score_thresh: float) -> bool:
+        iou_ok = self.iou_floor <= 0.0 or pred_iou_thresh >= self.iou_floor
+        stability_ok = self.stability_floor <= 0.0 or stability_score_thresh >= self.stability_floor
+        return iou_ok and stability_ok
+
+    def rle(self, idx: int) -> dict[str, Any]:
+        start, end = int(self.rle_offsets[idx]), int(self.rle_offsets[idx + 1])
+        return {"size": [self.height, self.width], "counts": self.rle_counts[start:end].tolist()}
+
+    def take(self, indices: np.ndarray) -> ProposalSet:
+        starts = self.rle_offsets[indices]
+        ends = self.rle_offsets[indices + 1]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(ends - starts)
+        counts = [self.rle_counts[start:end] for start, end in zip(starts, ends)]
+        return replace(
+            self,
+            iou_preds=self.iou_preds[indices],
+            stability_scores=self.stability_scores[indices],
+            points=self.points[indices],
+            boxes=self.boxes[indices],
+            rle_counts=np.concatenate(counts) if counts else np.zeros(0, dtype=np.uint32),
+            rle_offsets=offsets,
+        )
+
+    def packed(self, idx: int) -> PackedMask | None:
+        start, end = int(self.rle_offsets[idx]), int(self.rle_offsets[idx + 1])
+        return PackedMask.from_rle(self.rle_counts[start:end], self.height, self.width)
+
+    def to_arrays(self) -> tuple[dict[str, np.ndarray], dict[str, Any]]:
+        arrays = {
+            "iou_preds": self.iou_preds,
+            "stability_scores": self.stability_scores,
+            "points": self.points,
+            "boxes": self.boxes,
+            "rle_counts": self.rle_counts,
+            "rle_offsets": self.rle_offsets,
+        }
+        info = {
+            "height": self.height,
+            "width": self.width,
+            "iou_floor": self.iou_floor,
+            "stability_floor": self.stability_floor,
+        }
+        return arrays, info
+
+    @classmethod
+    def from_arrays(
+        cls, arrays: dict[str, np.ndarray], info: dict[str, Any]
+    ) -> tuple[ProposalSet, int]:
+        proposals = cls(
+            height=int(info["height"]),
+            width=int(info["width"]),
+            iou_floor=float(info["iou_floor"]),
+            stability_floor=float(info["stability_floor"]),
+            **arrays,
+        )
+        return proposals, proposals.nbytes
+
+
+@dataclass
+class Sam2Caches:
+    embeddings: ByteBudgetLRU
+    proposals: ByteBudgetLRU
+    results: ByteBudgetLRU
+    proposal_iou_floor: float
+    proposal_stability_floor: float
+    disk: DiskCache | None = None
+
+
+def encode_response(value: tuple[bytes, str]) -> tuple[dict[str, np.ndarray], dict[str, Any]]:
+    body, media_type = value
+    return {"body": np.frombuffer(body, dtype=np.uint8)}, {"media_type": media_type}
+
+
+def decode_response(arrays: dict[str, np.ndarray], info: dict[str, Any]) -> tuple[Any, int]:
+    body = arrays["body"].tobytes()
+    return (body, str(info["media_type"])), len(body)
+
+
+def build_caches(device: str, share: int = 1) -> Sam2Caches:
+    # share > 1 splits the in-memory embedding and proposal budgets between that many worker
+    # processes, each caching its own slice of the images.
+    disk = resolve_disk_cache()
+    return Sam2Caches(
+        embeddings=TieredCache(
+            env_megabytes("SAM2_EMBEDDING_CACHE_MB", 512) // share,
+            "embedding",
+            disk,
+            encode_features,
+            feature_decoder(device),
+        ),
+        proposals=TieredCache(
+            env_megabytes("SAM2_PROPOSAL_CACHE_MB", 256) // share,
+            "proposals",
+            disk,
+            ProposalSet.to_arrays,
+            ProposalSet.from_arrays,
+        ),
+        results=TieredCache(
+            env_megabytes("SAM2_RESULT_CACHE_MB", 128),
+            "result",
+            disk,
+            encode_response,
+            decode_response,
+        ),
+        proposal_iou_floor=env_float("SAM2_PROPOSAL_IOU_FLOOR", 0.5),
+        proposal_stability_floor=env_float("SAM2_PROPOSAL_STABILITY_FLOOR", 0.5),
+        disk=disk,
+    )
+
+
+def model_identity(cfg: Sam2Config) -> str:
+    checkpoint = Path(cfg.checkpoint_path)
+    try:
+        stat = checkpoint.stat()
+        checkpoint_version = f"{stat.st_size}:{int(stat.st_mtime)}"
+    except OSError:
+        checkpoint_version = "missing"
+    raw = f"{cfg.config_path}|{checkpoint.resolve()}|{checkpoint_version}|{cfg.device}"
+    if cfg.quantization != "none":
+        raw += f"|{cfg.quantization}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def result_cache_key(endpoint: str, image_bytes: bytes, req: SegmentRequest, model_id: str) -> str:
+    scope = {
+        "endpoint": endpoint,
+        # The resolved model and precision are covered by model_id, so explicit defaults share entries.
+        "params": req.model_dump(exclude={"image", "model", "precision", "deadline_ms"}),
+        "server": SERVER_VERSION,
+        "model": model_id,
+    }
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(json.dumps(scope, sort_keys=True).encode("utf-8"))
+    hasher.update(image_bytes)
+    return hasher.hexdigest()
+
+
+def cached_response(results: ByteBudgetLRU, key: str) -> Response | None:
+    cached = results.get(key)
+    if cached is None:
+        return None
+    body, media_type = cached
+    return Response(content=body, media_type=media_type, headers={"X-SAM2-Cache": "hit"})
+
+
+def remember_response(results: ByteBudgetLRU, key: str, response: Response) -> Response:
+    results.put(key, (bytes(response.body), response.media_type), len(response.body))
+    response.headers["X-SAM2-Cache"] = "miss"
+    return response
+
+
+PRECISIONS = ("fp32", "bf16")
+
+
+def inference_precision(device: Any, precision: str) -> AbstractContextManager[Any]:
+    if precision != "bf16":
+        return nullcontext()
+    import torch
+
+    # Autocast runs matmuls and convolutions in bf16 and keeps numerically sensitive ops in fp32.
+    device_type = device.type if hasattr(device, "type") else str(device).split(":")[0]
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+
+
+def inference_identity(model_id: str, precision: str) -> str:
+    # bf16 embeddings and masks differ slightly from fp32, so they are cached separately.
+    return model_id if precision == "fp32" else f"{model_id}+{precision}"
+
+
+def resolve_precision(requested: str | None, default: str, cfg: Sam2Config) -> str:
+    precision = requested or default
+    if precision == "bf16" and cfg.quantization != "none":
+        if requested is None:
+            return "fp32"
+        raise HTTPException(
+            status_code=400,
+            detail=f"Model '{cfg.name}' is {cfg.quantization}-quantized and does not support bf16",
+        )
+    return precision
+
+
+def cpu_bf16_supported() -> bool:
+    import torch
+
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+
+def decode_point_batch(
+    generator: SAM2AutomaticMaskGenerator,
+    points: np.ndarray,
+    im_size: tuple[int, int],
+    iou_floor: float,
+    stability_floor: float,
+) -> MaskData:
+    # Same steps as SAM2AutomaticMaskGenerator._process_batch(), except that only the floors are
+    # applied so the result can later be re-filtered for any stricter thresholds.
+    import torch
+    from sam2.utils.amg import (
+        MaskData,
+        batched_mask_to_box,
+        calculate_stability_score,
+        is_box_near_crop_edge,
+        mask_to_rle_pytorch,
+    )
+
+    predictor = generator.predictor
+    h, w = im_size
+    points_t = torch.as_tensor(points, dtype=torch.float32, device=predictor.device)
+    in_points = predictor._transforms.transform_coords(points_t, normalize=True, orig_hw=im_size)
+    in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
+    masks, iou_preds, low_res_masks = predictor._predict(
+        in_points[:, None, :],
+        in_labels[:, None],
+        multimask_output=getattr(generator, "multimask_output", True),
+        return_logits=True,
+    )
+    # Under bf16 autocast the decoder returns bf16; thresholds and scores stay in fp32.
+    data = MaskData(
+        masks=masks.flatten(0, 1).float(),
+        iou_preds=iou_preds.flatten(0, 1).float(),
+        points=points_t.repeat_interleave(masks.shape[1], dim=0),
+        low_res_masks=low_res_masks.flatten(0, 1),
+    )
+    del masks
+
+    if getattr(generator, "use_m2m", False):
+        in_points = predictor._transforms.transform_coords(
+            data["points"], normalize=True, orig_hw=im_size
+        )
+        labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
+        masks, ious = generator.refine_with_m2m(
+            in_points, labels, data["low_res_masks"], generator.points_per_batch
+        )
+        data["masks"] = masks.squeeze(1).float()
+        data["iou_preds"] = ious.squeeze(1).float()
+    del data["low_res_masks"]
+
+    if iou_floor > 0.0:
+        data.filter(data["iou_preds"] > iou_floor)
+    data["stability_score"] = calculate_stability_score(
+        data["masks"], generator.mask_threshold, generator.stability_score_offset
+    )
+    if stability_floor > 0.0:
+        data.filter(data["stability_score"] >= stability_floor)
+
+    data["masks"] = data["masks"] > generator.mask_threshold
+    data["boxes"] = batched_mask_to_box(data["masks"])
+    keep_mask = ~is_box_near_crop_edge(data["boxes"], [0, 0, w, h], [0, 0, w, h])
+    if not torch.all(keep_mask):
+        data.filter(keep_mask)
+
+    data["rles"] = mask_to_rle_pytorch(data["masks"])
+    del data["masks"]
+    return data
+
+
+def decode_proposals(
+    generator: SAM2AutomaticMaskGenerator,
+    rgb: np.ndarray,
+    image_key: str,
+    embedding_cache: ByteBudgetLRU,
+    iou_floor: float,
+    stability_floor: float,
+    timings: dict[str, float] | None = None,
+    precision: str = "fp32",
+    features: dict[str, Any] | None = None,
+    control: RunControl | None = None,
+) -> ProposalSet:
+    # The server never enables crop layers, so the whole image is the only crop.
+    from sam2.utils.amg import MaskData, batch_iterator
+
+    h, w = rgb.shape[0], rgb.shape[1]
+    predictor = generator.predictor
+    started = time.perf_counter()
+    if control is not None:
+        control.report("encoding image", 0.05)
+    try:
+        with inference_precision(predictor.device, precision):
+            set_image_cached(predictor, rgb, image_key, embedding_cache, features)
+            encoded = time.perf_counter()
+
+            points_for_image = generator.point_grids[0] * np.array([[w, h]])
+            batch_count = -(-len(points_for_image) // generator.points_per_batch)
+            if control is not None:
+                control.report("image encoded", 0.2, batches_done=0, batches_total=batch_count)
+            data = MaskData()
+            for idx, (points,) in enumerate(batch_iterator(generator.points_per_batch, points_for_image)):
+                # An abandoned run frees its slot after at most one more point batch.
+                if control is not None:
+                    control.checkpoint()
+                data.cat(decode_point_batch(generator, points, (h, w), iou_floor, stability_floor))
+                if control is not None:
+                    control.report(
+                        "decoding masks",
+                        0.2 + 0.6 * (idx + 1) / batch_count,
+                        batches_done=idx + 1,
+                        batches_total=batch_count,
+                    )
+    finally:
+        predictor.reset_predictor()
+    data.to_numpy()
+    if timings is not None:
+        timings["encode_ms"] = (encoded - started) * 1000.0
+        timings["decode_ms"] = (time.perf_counter() - encoded) * 1000.0
+
+    counts = [np.asarray(rle["counts"], dtype=np.uint32) for rle in data["rles"]]
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([c.size for c in counts])
+    return ProposalSet(
+        height=h,
+        width=w,
+        iou_preds=np.asarray(data["iou_preds"], dtype=np.float32),
+        stability_scores=np.asarray(data["stability_score"], dtype=np.float32),
+        points=np.asarray(data["points"], dtype=np.float32).reshape(-1, 2),
+        boxes=np.asarray(data["boxes"], dtype=np.int32).reshape(-1, 4),
+        rle_counts=np.concatenate(counts) if counts else np.zeros(0, dtype=np.uint32),
+        rle_offsets=offsets,
+        iou_floor=iou_floor,
+        stability_floor=stability_floor,
+    )
+
+
+def filter_proposals(
+    proposals: ProposalSet,
+    pred_iou_thresh: float,
+    stability_score_thresh: float,
+    box_nms_thresh: float,
+) -> ProposalSet:
+    # The proposals that pass the request thresholds and NMS, in NMS order, still as RLE.
+    import torch
+    from torchvision.ops.boxes import batched_nms
+
+    keep = np.ones(proposals.iou_preds.shape[0], dtype=bool)
+    if pred_iou_thresh > 0.0:
+        keep &= proposals.iou_preds > pred_iou_thresh
+    if stability_score_thresh > 0.0:
+        keep &= proposals.stability_scores >= stability_score_thresh
+    candidates = np.nonzero(keep)[0]
+    if candidates.size == 0:
+        return proposals.take(candidates)
+
+    boxes = torch.as_tensor(proposals.boxes[candidates], dtype=torch.float32)
+    keep_by_nms = batched_nms(
+        boxes,
+        torch.as_tensor(proposals.iou_preds[candidates]),
+        torch.zeros_like(boxes[:, 0]),
+        iou_threshold=box_nms_thresh,
+    )
+    return proposals.take(candidates[keep_by_nms.numpy()])
+
+
+def proposal_masks(proposals: ProposalSet) -> list[dict[str, Any]]:
+    # Masks are decoded one at a time straight into their packed form, so the full-size bool of
+    # each exists only while it is being packed. Empty masks add nothing to any result and are
+    # dropped here.
+    items: list[dict[str, Any]] = []
+    for idx in range(proposals.iou_preds.shape[0]):
+        mask = proposals.packed(idx)
+        if mask is None:
+            continue
+        items.append(
+            {
+                "segmentation": mask,
+                "area": mask.area,
+                "predicted_iou": float(proposals.iou_preds[idx]),
+                "stability_score": float(proposals.stability_scores[idx]),
+                "point_coords": [proposals.points[idx].tolist()],
+            }
+        )
+    return items
+
+
+def select_proposals(
+    proposals: ProposalSet,
+    pred_iou_thresh: float,
+    stability_score_thresh: float,
+    box_nms_thresh: float,
+) -> list[dict[str, Any]]:
+    return proposal_masks(
+        filter_proposals(proposals, pred_iou_thresh, stability_score_thresh, box_nms_thresh)
+    )
+
+
+def mask_cache_keys(rgb: np.ndarray, req: SegmentRequest, model_id: str) -> tuple[str, str]:
+    image_key = f"{model_id}:{image_digest(rgb)}"
+    return image_key, f"{image_key}:pps={req.points_per_side}:m2m={int(req.use_m2m)}"
+
+
+def needs_encoder_pass(caches: Sam2Caches, rgb: np.ndarray, req: SegmentRequest, model_id: str) -> bool:
+    # Best effort: cached proposals that turn out not to cover the thresholds still get encoded,
+    # just without batching.
+    image_key, proposal_key = mask_cache_keys(rgb, req, model_id)
+    return image_key not in caches.embeddings and proposal_key not in caches.proposals
+
+
+def generate_proposals(
+    generator: SAM2AutomaticMaskGenerator,
+    rgb: np.ndarray,
+    req: SegmentRequest,
+    caches: Sam2Caches,
+    model_id: str,
+    precision: str = "fp32",
+    features: dict[str, Any] | None = None,
+    control: RunControl | None = None,
+) -> ProposalSet:
+    # Equivalent of generator.generate(rgb), with the masks still as RLE. Proposals are cached per image and prompt grid, so a
+    # request that only moves the thresholds is answered without touching the model.
+    image_key, proposal_key = mask_cache_keys(rgb, req, model_id)
+    proposals = caches.proposals.get(proposal_key)
+    if proposals is None or not proposals.covers(req.pred_iou_thresh, req.stability_score_thresh):
+        proposals = decode_proposals(
+            generator,
+            rgb,
+            image_key,
+            caches.embeddings,
+            iou_floor=min(caches.proposal_iou_floor, req.pred_iou_thresh),
+            stability_floor=min(caches.proposal_stability_floor, req.stability_score_thresh),
+            precision=precision,
+            features=features,
+            control=control,
+        )
+        caches.proposals.put(proposal_key, proposals, proposals.nbytes)
+
+    return filter_proposals(
+        proposals, req.pred_iou_thresh, req.stability_score_thresh, generator.box_nms_thresh
+    )
+
+
 def combine_masks(mask_items: list[dict[str, Any]], height: int, width: int) -> np.ndarray:
     if not mask_items:
         return np.zeros((height, width), dtype=np.uint8)
 
-    combined = np.zeros((height, width), dtype=bool)
+    # The union is taken on the packed words and unpacked once.
+    combined: np.ndarray | None = None
     for item in mask_items:
         seg = item.get("segmentation")
-        if seg is None:
+        if seg is None or seg.shape != (height, width):
             continue
-        seg_arr = np.asarray(seg, dtype=bool)
-        if seg_arr.shape != (height, width):
-            continue
-        combined |= seg_arr
+        if combined is None:
+            combined = seg.bits.copy()
+        else:
+            combined |= seg.bits
+    if combined is None:
+        return np.zeros((height, width), dtype=np.uint8)
 
-    return combined.astype(np.uint8) * 255
+    return unpack_rows(combined, width).astype(np.uint8) * 255
 
 
 def png_response_from_mask(mask_luma: np.ndarray) -> Response:
@@ -139,6 +1030,79 @@ def png_response_from_mask(mask_luma: np.ndarray) -> Response:
     return Response(content=out.getvalue(), media_type="image/png")
 
 
+# Output formats and the media types that select them through Accept. The first entry is the default.
+SEGMENT_FORMATS = {
+    "png": "image/png",
+    "packbits": "application/x-sam2-packbits",
+    "rle": "application/x-sam2-rle+json",
+}
+PARTS_FORMATS = {
+    "json": "application/json",
+    "labelmap": "application/x-sam2-labelmap+json",
+}
+PACKBITS_MAGIC = b"SAM2MASK"
+
+
+def negotiate_format(requested: str | None, accept: str, formats: dict[str, str]) -> str:
+    if requested is not None:
+        return requested
+    by_media_type = {media_type: name for name, media_type in formats.items()}
+    ranked: list[tuple[float, int, str]] = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type.strip().lower() in by_media_type and quality > 0.0:
+            ranked.append((-quality, position, by_media_type[media_type.strip().lower()]))
+    return min(ranked)[2] if ranked else next(iter(formats))
+
+
+def packbits_response(mask: np.ndarray) -> Response:
+    # 16-byte header (magic, height, width as little-endian uint32) followed by the mask rows,
+    # eight pixels per byte, most significant bit first. Each row is padded to whole bytes.
+    h, w = mask.shape
+    header = PACKBITS_MAGIC + np.array([h, w], dtype="<u4").tobytes()
+    body = header + np.packbits(mask, axis=1).tobytes()
+    return Response(content=body, media_type=SEGMENT_FORMATS["packbits"])
+
+
+def mask_to_coco_rle(mask: np.ndarray) -> dict[str, Any]:
+    # Uncompressed COCO RLE: run lengths over the column-major pixels, starting with a run of zeros.
+    # Run boundaries are found on the row-major array (changes down each column, plus the seam
+    # between the bottom of one column and the top of the next), which avoids a transposed copy.
+    h, w = mask.shape
+    rows, cols = np.nonzero(mask[1:] != mask[:-1])
+    seams = np.flatnonzero(mask[0, 1:] != mask[-1, :-1]) + 1
+    changes = np.sort(np.concatenate((cols.astype(np.int64) * h + rows + 1, seams.astype(np.int64) * h)))
+    counts = np.diff(np.concatenate(([0], changes, [h * w])))
+    if mask.size and mask[0, 0]:
+        counts = np.concatenate(([0], counts))
+    return {"size": [int(h), int(w)], "counts": counts.tolist()}
+
+
+def mask_response(mask_luma: np.ndarray, fmt: str) -> Response:
+    if fmt == "packbits":
+        return packbits_response(mask_luma > 0)
+    if fmt == "rle":
+        return JSONResponse(mask_to_coco_rle(mask_luma > 0), media_type=SEGMENT_FORMATS["rle"])
+    return png_response_from_mask(mask_luma)
+
+
+def encode_label_map(labeled_regions: list[tuple[str, np.ndarray]], height: int, width: int) -> str:
+    # One uint8 per pixel: 0 is background and N is region_NN. zlib level 1 keeps it cheap to
+    # produce and the browser inflates it with DecompressionStream("deflate").
+    label_map = np.zeros((height, width), dtype=np.uint8)
+    for idx, (_, region_mask) in enumerate(labeled_regions):
+        label_map[region_mask] = idx + 1
+    return base64.b64encode(zlib.compress(label_map.tobytes(), 1)).decode("ascii")
+
+
 def data_url_from_pil_png(image: Image.Image) -> str:
     out = io.BytesIO()
     image.save(out, format="PNG")
@@ -164,10 +1128,86 @@ def centroid_from_mask(mask: np.ndarray) -> tuple[float, float] | None:
     return (float(xs.mean()), float(ys.mean()))
 
 
-def mask_touches_border(mask: np.ndarray) -> bool:
-    if mask.shape[0] == 0 or mask.shape[1] == 0:
-        return False
-    return bool(mask[0, :].any() or mask[-1, :].any() or mask[:, 0].any() or mask[:, -1].any())
+def unpack_rows(bits: np.ndarray, width: int) -> np.ndarray:
+    # The bool mask of packed rows as PackedMask stores them.
+    return np.unpackbits(bits.view(np.uint8), axis=1, count=width).view(bool)
+
+
+# Set bits per byte value, for numpy releases without np.bitwise_count (added in 2.0).
+POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1, dtype=np.uint8)
+
+
+def popcount(words: np.ndarray, axis: int | tuple[int, ...] | None = None) -> Any:
+    # Set bits summed over axis, which must include the last axis when given.
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=axis, dtype=np.int64)
+    return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=axis, dtype=np.int64)
+
+
+@dataclass(eq=False)
+class PackedMask:
+    # A non-empty bool mask as np.packbits rows, padded to whole uint64 words so intersections
+    # are an AND plus a popcount over 1/8 of the bytes. Area, bbox and centroid are computed
+    # once when packing.
+    bits: np.ndarray
+    width: int
+    area: int
+    bbox: tuple[int, int, int, int]
+    centroid: tuple[float, float]
+
+    @classmethod
+    def pack(cls, mask: np.ndarray) -> PackedMask:
+        h, w = mask.shape
+        row_counts = np.count_nonzero(mask, axis=1)
+        col_counts = np.count_nonzero(mask, axis=0)
+        area = int(row_counts.sum())
+        rows = np.flatnonzero(row_counts)
+        cols = np.flatnonzero(col_counts)
+        x0, x1 = int(cols[0]), int(cols[-1])
+        y0, y1 = int(rows[0]), int(rows[-1])
+        centroid = (
+            float(col_counts @ np.arange(w, dtype=np.int64)) / area,
+            float(row_counts @ np.arange(h, dtype=np.int64)) / area,
+        )
+        packed = np.packbits(mask, axis=1)
+        bits = np.zeros((h, (w + 63) // 64 * 8), dtype=np.uint8)
+        bits[:, : packed.shape[1]] = packed
+        return cls(
+            bits=bits.view(np.uint64),
+            width=w,
+            area=area,
+            bbox=(x0, y0, x1 - x0 + 1, y1 - y0 + 1),
+            centroid=centroid,
+        )
+
+    @classmethod
+    def from_rle(cls, counts: np.ndarray, height: int, width: int) -> PackedMask | None:
+        # Decodes SAM2's column-major RLE counts, which alternate runs of 0 and 1 starting with 0.
+        # None for an empty mask.
+        values = np.arange(len(counts)) % 2 == 1
+        mask = np.repeat(values, counts).reshape(width, height).T
+        if not mask.any():
+            return None
+        return cls.pack(mask)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return (int(self.bits.shape[0]), self.width)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.bits.nbytes)
+
+    def unpack(self) -> np.ndarray:
+        return unpack_rows(self.bits, self.width)
+
+    def touches_border(self) -> bool:
+        x, y, w, h = self.bbox
+        height, width = self.shape
+        return x == 0 or y == 0 or x + w == width or y + h == height
+
+    def intersection(self, other: PackedMask) -> int:
+        return int(popcount(self.bits & other.bits))
 
 
 def alpha_opaque_mask(image: Image.Image, alpha_threshold: int = 8) -> np.ndarray:
@@ -175,6 +1215,66 @@ def alpha_opaque_mask(image: Image.Image, alpha_threshold: int = 8) -> np.ndarra
     return alpha >= alpha_threshold
 
 
+def border_connected(mask: np.ndarray) -> np.ndarray:
+    # Pixels of mask 4-connected to the image border. The horizontal runs of mask are the nodes
+    # of a union-find; two runs on adjacent rows are joined when their columns overlap. Each
+    # overlap is one stretch of pixels set on both rows, so there are fewer joins than runs and
+    # the whole fill is linear in the pixel count however winding the background is.
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    run_ids = np.cumsum(starts, axis=None, dtype=np.int32).reshape(mask.shape)
+    run_ids[~mask] = 0
+    run_count = int(np.count_nonzero(starts))
+
+    shared = mask[:-1] & mask[1:]
+    overlap_starts = shared.copy()
+    overlap_starts[:, 1:] &= ~shared[:, :-1]
+    ys, xs = np.nonzero(overlap_starts)
+    upper = run_ids[ys, xs].tolist()
+    lower = run_ids[ys + 1, xs].tolist()
+
+    parent = list(range(run_count + 1))
+    for a, b in zip(upper, lower):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        while parent[b] != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    # Every run points at a smaller id, so one pass in id order flattens each onto its root.
+    for run in range(1, run_count + 1):
+        parent[run] = parent[parent[run]]
+    roots = np.array(parent, dtype=np.int32)
+
+    border = np.concatenate((run_ids[0], run_ids[-1], run_ids[:, 0], run_ids[:, -1]))
+    hit = np.zeros(run_count + 1, dtype=bool)
+    hit[roots[border]] = True
+    hit[0] = False
+    return hit[roots[run_ids]]
+
+
+def near_corner_colors(rgba: np.ndarray, threshold: int, tile_pixels: int = 1 << 20) -> np.ndarray:
+    # Pixels whose RGB L1 distance to any of the four corner colors is at most threshold. Rows are
+    # processed in tiles of about tile_pixels, one corner at a time, so the int16 temporaries stay
+    # a fixed size and the only full-size allocation is the bool result.
+    h, w = rgba.shape[0], rgba.shape[1]
+    corners = rgba[[0, 0, h - 1, h - 1], [0, w - 1, 0, w - 1], :3].astype(np.int16)
+    near = np.zeros((h, w), dtype=bool)
+    tile_rows = max(1, tile_pixels // w)
+    for y0 in range(0, h, tile_rows):
+        tile = rgba[y0 : y0 + tile_rows, :, :3].astype(np.int16)
+        out = near[y0 : y0 + tile_rows]
+        for corner in corners:
+            delta = tile - corner
+            np.abs(delta, out=delta)
+            # At most 3 * 255, so the channel sum fits in int16.
+            out |= delta.sum(axis=2, dtype=np.int16) <= threshold
+    return near
+
+
 def estimate_foreground_mask_from_edges(
     image: Image.Image,
     fallback_mask: np.ndarray,
@@ -191,50 +1291,8 @@ def estimate_foreground_mask_from_edges(
     if fallback_area < int(total * 0.94):
         return fallback_mask
 
-    rgb = rgba[:, :, :3].astype(np.int16)
-    corners = np.stack(
-        [rgb[0, 0], rgb[0, w - 1], rgb[h - 1, 0], rgb[h - 1, w - 1]], axis=0
-    )
-
-    diff = np.abs(rgb[:, :, None, :] - corners[None, None, :, :]).sum(axis=3)
-    min_diff = diff.min(axis=2)
-    threshold = int(channel_tolerance) * 3
-    candidate_bg = min_diff <= threshold
-
-    visited = np.zeros((h, w), dtype=bool)
-    q: deque[tuple[int, int]] = deque()
-
-    for x in range(w):
-        if candidate_bg[0, x]:
-            visited[0, x] = True
-            q.append((0, x))
-        if candidate_bg[h - 1, x] and not visited[h - 1, x]:
-            visited[h - 1, x] = True
-            q.append((h - 1, x))
-    for y in range(h):
-        if candidate_bg[y, 0] and not visited[y, 0]:
-            visited[y, 0] = True
-            q.append((y, 0))
-        if candidate_bg[y, w - 1] and not visited[y, w - 1]:
-            visited[y, w - 1] = True
-            q.append((y, w - 1))
-
-    while q:
-        y, x = q.popleft()
-        if y > 0 and candidate_bg[y - 1, x] and not visited[y - 1, x]:
-            visited[y - 1, x] = True
-            q.append((y - 1, x))
-        if y + 1 < h and candidate_bg[y + 1, x] and not visited[y + 1, x]:
-            visited[y + 1, x] = True
-            q.append((y + 1, x))
-        if x > 0 and candidate_bg[y, x - 1] and not visited[y, x - 1]:
-            visited[y, x - 1] = True
-            q.append((y, x - 1))
-        if x + 1 < w and candidate_bg[y, x + 1] and not visited[y, x + 1]:
-            visited[y, x + 1] = True
-            q.append((y, x + 1))
-
-    foreground = ~visited
+    candidate_bg = near_corner_colors(rgba, int(channel_tolerance) * 3)
+    foreground = ~border_connected(candidate_bg)
     fg_area = int(foreground.sum())
     if fg_area < int(total * 0.03) or fg_area > int(total * 0.97):
         return fallback_mask
@@ -242,21 +1300,19 @@ def estimate_foreground_mask_from_edges(
 
 
 def assign_part_label(
-    mask: np.ndarray,
+    mask: PackedMask,
     character_bbox: tuple[int, int, int, int],
     character_area: int,
 ) -> str:
-    bbox = bbox_from_mask(mask)
-    centroid = centroid_from_mask(mask)
-    if bbox is None or centroid is None or character_area <= 0:
+    if character_area <= 0:
         return "other"
 
     char_x, char_y, char_w, char_h = character_bbox
-    cx, cy = centroid
-    _, _, bw, bh = bbox
+    cx, cy = mask.centroid
+    _, _, bw, bh = mask.bbox
     nx = (cx - char_x) / max(1, char_w)
     ny = (cy - char_y) / max(1, char_h)
-    area_ratio = float(mask.sum()) / float(character_area)
+    area_ratio = float(mask.area) / float(character_area)
     bw_ratio = bw / max(1, char_w)
     bh_ratio = bh / max(1, char_h)
 
@@ -297,6 +1353,60 @@ def assign_part_label(
     return "other"
 
 
+def intersection_table(rows: list[PackedMask], cols: list[PackedMask]) -> np.ndarray:
+    # Intersection areas for every (row, col) pair: M_rows @ M_cols.T over flattened masks,
+    # computed on the packed words as AND plus popcount, one row mask against all cols at a
+    # time. Bits outside a mask's bbox are zero, so each row only reads the window of its bbox:
+    # its rows and the 64-pixel words covering its columns.
+    table = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    if not cols:
+        return table
+    for i, mask in enumerate(rows):
+        x, y, w, h = mask.bbox
+        window = (slice(y, y + h), slice(x // 64, (x + w - 1) // 64 + 1))
+        col_bits = np.stack([col.bits[window] for col in cols])
+        table[i] = popcount(col_bits & mask.bits[window], axis=(1, 2))
+    return table
+
+
+def select_part_masks(masks: list[PackedMask], min_area: int, max_regions: int) -> list[PackedMask]:
+    # Largest first, skipping near-duplicates and masks almost entirely inside a kept one. A kept
+    # mask whose bbox misses the candidate's has no overlap and can't make it a duplicate, so
+    # only the overlapping ones get their row of the intersection table, read within the
+    # candidate's bbox. The cost follows the size of the parts and how many overlap, not the
+    # image size.
+    candidates = sorted((m for m in masks if m.area >= min_area), key=lambda m: m.area, reverse=True)
+    # Kept bboxes as x0, y0, x1, y1 (exclusive). At most max_regions (40) are ever kept, so one
+    # vectorized overlap test over all of them is cheaper than maintaining an R-tree or grid.
+    kept_boxes = np.empty((max_regions, 4), dtype=np.int64)
+    selected: list[PackedMask] = []
+    for mask in candidates:
+        x, y, w, h = mask.bbox
+        boxes = kept_boxes[: len(selected)]
+        near = np.flatnonzero(
+            (boxes[:, 0] < x + w) & (boxes[:, 2] > x) & (boxes[:, 1] < y + h) & (boxes[:, 3] > y)
+        )
+        if near.size:
+            overlapping = [selected[i] for i in near]
+            area = float(mask.area)
+            kept_area = np.array([kept.area for kept in overlapping], dtype=np.float64)
+            inter = intersection_table([mask], overlapping)[0].astype(np.float64)
+            iou = inter / (area + kept_area - inter)
+            size_ratio = area / kept_area
+            containment = inter / area
+            duplicate = ((iou >= 0.92) & (size_ratio >= 0.8) & (size_ratio <= 1.25)) | (
+                (containment >= 0.985) & (size_ratio >= 0.9)
+            )
+            if duplicate.any():
+                continue
+
+        kept_boxes[len(selected)] = (x, y, x + w, y + h)
+        selected.append(mask)
+        if len(selected) >= max_regions:
+            break
+    return selected
+
+
 def build_part_masks(
     mask_items: list[dict[str, Any]],
     height: int,
@@ -317,23 +1427,25 @@ def build_part_masks(
     else:
         opaque_mask = None
 
-    masks: list[np.ndarray] = []
+    # Proposals arrive bit-packed and stay that way: hundreds of them at full resolution would
+    # otherwise hold one byte per pixel each until the dedup below has picked at most
+    # max_regions. Only the one being clipped to the opaque mask is unpacked at a time.
+    character_bits = np.zeros((height, (width + 63) // 64), dtype=np.uint64)
+    masks: list[PackedMask] = []
     for item in mask_items:
         seg = item.get("segmentation")
-        if seg is None:
-            continue
-        arr = np.asarray(seg, dtype=bool)
-        if arr.shape != (height, width):
+        if seg is None or seg.shape != (height, width):
             continue
 
-        raw_area = int(arr.sum())
+        raw_area = seg.area
         if raw_area <= 0:
             continue
 
-        region = arr
+        region = seg
         if opaque_mask is not None:
-            region = arr & opaque_mask
-            region_area = int(region.sum())
+            clipped = seg.unpack()
+            clipped &= opaque_mask
+            region_area = int(np.count_nonzero(clipped))
             if region_area <= 0:
                 continue
 
@@ -341,26 +1453,27 @@ def build_part_masks(
             overlap_ratio = float(region_area) / float(max(1, raw_area))
             if overlap_ratio < 0.18:
                 continue
+            if region_area < raw_area:
+                region = PackedMask.pack(clipped)
         else:
             region_area = raw_area
 
         # Reject giant border-connected regions; these are usually background leakage.
         reference_area = max(1, opaque_area if opaque_area > 0 else height * width)
-        if mask_touches_border(region) and float(region_area) / float(reference_area) > 0.78:
+        if region.touches_border() and float(region_area) / float(reference_area) > 0.78:
             continue
 
+        character_bits |= region.bits
         masks.append(region)
 
+    character_mask = unpack_rows(character_bits, width)
+
     if not masks:
         if opaque_mask is not None and int(opaque_mask.sum()) > 0:
             return opaque_mask.copy(), {"other": opaque_mask.copy()}, [("other", opaque_mask.copy())]
         empty = np.zeros((height, width), dtype=bool)
         return empty, {}, []
 
-    character_mask = np.zeros((height, width), dtype=bool)
-    for arr in masks:
-        character_mask |= arr
-
     if opaque_mask is not None:
         character_mask &= opaque_mask
 
@@ -373,48 +1486,17 @@ def build_part_masks(
 
     min_area = max(32, int(character_area * 0.0015))
 
-    masks_sorted = sorted(masks, key=lambda m: int(m.sum()), reverse=True)
-    selected: list[np.ndarray] = []
-    for arr in masks_sorted:
-        area = int(arr.sum())
-        if area < min_area:
-            continue
-
-        is_duplicate = False
-        for existing in selected:
-            existing_area = int(existing.sum())
-            if existing_area <= 0:
-                continue
-            inter = int((arr & existing).sum())
-            union = int((arr | existing).sum())
-            if union <= 0:
-                continue
-            iou = float(inter) / float(union)
-            size_ratio = float(area) / float(max(1, existing_area))
-            containment = float(inter) / float(max(1, area))
-            if iou >= 0.92 and 0.8 <= size_ratio <= 1.25:
-                is_duplicate = True
-                break
-            if containment >= 0.985 and size_ratio >= 0.9:
-                is_duplicate = True
-                break
-
-        if is_duplicate:
-            continue
-
-        selected.append(arr.copy())
-        if len(selected) >= max_regions:
-            break
-
+    selected = select_part_masks(masks, min_area, max_regions)
     if not selected:
-        selected = [character_mask]
+        selected = [PackedMask.pack(character_mask)]
 
     char_bbox = bbox_from_mask(character_mask) or (0, 0, width, height)
     merged: dict[str, np.ndarray] = {}
     labeled_regions: list[tuple[str, np.ndarray]] = []
-    for region in selected:
-        label = assign_part_label(region, char_bbox, character_area)
-        labeled_regions.append((label, region.copy()))
+    for mask in selected:
+        label = assign_part_label(mask, char_bbox, character_area)
+        region = mask.unpack()
+        labeled_regions.append((label, region))
         if label in merged:
             merged[label] |= region
         else:
@@ -429,7 +1511,7 @@ def build_part_masks(
             labeled_regions = [(label, reg) for label, reg in labeled_regions if label != "torso"]
 
     if "torso" not in merged and selected:
-        primary_mask = selected[0].copy()
+        primary_mask = selected[0].unpack()
         for key in ("head", "left_arm", "right_arm", "left_leg", "right_leg", "weapon_or_accessory"):
             if key in merged:
                 primary_mask &= ~merged[key]
@@ -464,7 +1546,8 @@ def build_parts_preview(
     source_rgba: Image.Image,
     character_mask: np.ndarray,
     part_masks: dict[str, np.ndarray],
-) -> tuple[str, list[dict[str, Any]]]:
+    render: bool = True,
+) -> tuple[str | None, list[dict[str, Any]]]:
     color_map: dict[str, tuple[int, int, int]] = {
         "head": (255, 99, 132),
         "torso": (54, 162, 235),
@@ -476,8 +1559,7 @@ def build_parts_preview(
         "other": (129, 255, 161),
     }
 
-    src = np.asarray(source_rgba.convert("RGBA"), dtype=np.uint8).copy()
-    out = src.copy()
+    out = np.asarray(source_rgba.convert("RGBA"), dtype=np.uint8).copy() if render else None
 
     total_area = int(character_mask.sum())
     parts: list[dict[str, Any]] = []
@@ -493,9 +1575,10 @@ def build_parts_preview(
 
         color = color_map.get(label, color_map["other"])
         alpha = 0.48
-        out[mask, 0] = np.clip((1.0 - alpha) * out[mask, 0] + alpha * color[0], 0, 255).astype(np.uint8)
-        out[mask, 1] = np.clip((1.0 - alpha) * out[mask, 1] + alpha * color[1], 0, 255).astype(np.uint8)
-        out[mask, 2] = np.clip((1.0 - alpha) * out[mask, 2] + alpha * color[2], 0, 255).astype(np.uint8)
+        if render:
+            out[mask, 0] = np.clip((1.0 - alpha) * out[mask, 0] + alpha * color[0], 0, 255).astype(np.uint8)
+            out[mask, 1] = np.clip((1.0 - alpha) * out[mask, 1] + alpha * color[1], 0, 255).astype(np.uint8)
+            out[mask, 2] = np.clip((1.0 - alpha) * out[mask, 2] + alpha * color[2], 0, 255).astype(np.uint8)
 
         parts.append(
             {
@@ -508,6 +1591,10 @@ def build_parts_preview(
             }
         )
 
+    if not render:
+        parts.sort(key=lambda p: p["area"], reverse=True)
+        return None, parts
+
     preview = Image.fromarray(out, mode="RGBA")
     draw = ImageDraw.Draw(preview)
     for part in parts:
@@ -526,7 +1613,8 @@ def build_regions_preview(
     source_rgba: Image.Image,
     character_mask: np.ndarray,
     labeled_regions: list[tuple[str, np.ndarray]],
-) -> tuple[str, list[dict[str, Any]]]:
+    render: bool = True,
+) -> tuple[str | None, list[dict[str, Any]]]:
     palette: list[tuple[int, int, int]] = [
         (255, 99, 132),
         (54, 162, 235),
@@ -542,8 +1630,7 @@ def build_regions_preview(
         (120, 180, 255),
     ]
 
-    src = np.asarray(source_rgba.convert("RGBA"), dtype=np.uint8).copy()
-    out = src.copy()
+    out = np.asarray(source_rgba.convert("RGBA"), dtype=np.uint8).copy() if render else None
     total_area = int(character_mask.sum())
     regions: list[dict[str, Any]] = []
 
@@ -559,15 +1646,16 @@ def build_regions_preview(
 
         color = palette[idx % len(palette)]
         alpha = 0.52
-        out[region_mask, 0] = np.clip(
-            (1.0 - alpha) * out[region_mask, 0] + alpha * color[0], 0, 255
-        ).astype(np.uint8)
-        out[region_mask, 1] = np.clip(
-            (1.0 - alpha) * out[region_mask, 1] + alpha * color[1], 0, 255
-        ).astype(np.uint8)
-        out[region_mask, 2] = np.clip(
-            (1.0 - alpha) * out[region_mask, 2] + alpha * color[2], 0, 255
-        ).astype(np.uint8)
+        if render:
+            out[region_mask, 0] = np.clip(
+                (1.0 - alpha) * out[region_mask, 0] + alpha * color[0], 0, 255
+            ).astype(np.uint8)
+            out[region_mask, 1] = np.clip(
+                (1.0 - alpha) * out[region_mask, 1] + alpha * color[1], 0, 255
+            ).astype(np.uint8)
+            out[region_mask, 2] = np.clip(
+                (1.0 - alpha) * out[region_mask, 2] + alpha * color[2], 0, 255
+            ).astype(np.uint8)
 
         region_id = f"region_{idx + 1:02d}"
         regions.append(
@@ -582,6 +1670,10 @@ def build_regions_preview(
             }
         )
 
+    if not render:
+        regions.sort(key=lambda r: r["area"], reverse=True)
+        return None, regions
+
     preview = Image.fromarray(out, mode="RGBA")
     draw = ImageDraw.Draw(preview)
     for region in regions:
@@ -596,25 +1688,90 @@ def build_regions_preview(
     return data_url_from_pil_png(preview), regions
 
 
-def resolve_sam2_config() -> Sam2Config:
-    server_dir = Path(__file__).resolve().parent
-    default_checkpoint = server_dir / "checkpoints" / "sam2.1_hiera_small.pt"
+MODEL_VARIANTS: dict[str, tuple[str, str]] = {
+    "tiny": ("sam2.1_hiera_t.yaml", "sam2.1_hiera_tiny.pt"),
+    "small": ("sam2.1_hiera_s.yaml", "sam2.1_hiera_small.pt"),
+    "base_plus": ("sam2.1_hiera_b+.yaml", "sam2.1_hiera_base_plus.pt"),
+    "large": ("sam2.1_hiera_l.yaml", "sam2.1_hiera_large.pt"),
+}
+INT8_SUFFIX = "-int8"
 
-    default_config = server_dir / "configs" / "sam2.1" / "sam2.1_hiera_s.yaml"
-    if not default_config.exists():
-        try:
-            import sam2 as sam2_pkg
 
-            pkg_dir = Path(sam2_pkg.__file__).resolve().parent
-            pkg_config = pkg_dir / "configs" / "sam2.1" / "sam2.1_hiera_s.yaml"
-            if pkg_config.exists():
-                default_config = pkg_config
-        except Exception:
+def sam2_package_dir() -> Path | None:
+    try:
+        import sam2 as sam2_pkg
+
+        return Path(sam2_pkg.__file__).resolve().parent
+    except Exception:
+        return None
+
+
+def default_config_path(config_name: str) -> Path:
+    local_config = Path(__file__).resolve().parent / "configs" / "sam2.1" / config_name
+    if local_config.exists():
+        return local_config
+    pkg_dir = sam2_package_dir()
+    if pkg_dir is not None:
+        pkg_config = pkg_dir / "configs" / "sam2.1" / config_name
+        if pkg_config.exists():
+            return pkg_config
+    return local_config
+
+
+def hydra_config_name(config_path: str) -> str:
+    # build_sam2() resolves configs through Hydra's search path rooted at the sam2 package, which
+    # rejects absolute paths. Configs shipped with the package are passed relative to it.
+    pkg_dir = sam2_package_dir()
+    if pkg_dir is not None:
+        try:
+            return Path(config_path).resolve().relative_to(pkg_dir).as_posix()
+        except ValueError:
             pass
+    return config_path
+
+
+def resolve_model_variants() -> tuple[dict[str, Sam2Config], str]:
+    import torch
+
+    server_dir = Path(__file__).resolve().parent
+    device = os.environ.get("SAM2_DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
+
+    variants: dict[str, Sam2Config] = {
+        name: Sam2Config(
+            name=name,
+            config_path=str(default_config_path(config_name)),
+            checkpoint_path=str(server_dir / "checkpoints" / checkpoint_name),
+            device=device,
+        )
+        for name, (config_name, checkpoint_name) in MODEL_VARIANTS.items()
+    }
+
+    # Extra config+checkpoint pairs: {"name": {"config": "...", "checkpoint": "..."}}
+    models_file = Path(os.environ.get("SAM2_MODELS_FILE", "") or server_dir / "models.json")
+    if models_file.exists():
+        try:
+            custom = json.loads(models_file.read_text(encoding="utf-8"))
+            for name, entry in custom.items():
+                variants[str(name)] = Sam2Config(
+                    name=str(name),
+                    config_path=str(entry["config"]),
+                    checkpoint_path=str(entry["checkpoint"]),
+                    device=device,
+                )
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as exc:
+            print(f"[WARN] Ignoring model registry file '{models_file}': {exc}")
+
+    default_name = os.environ.get("SAM2_MODEL", "").strip() or "small"
+    base_name = default_name.removesuffix(INT8_SUFFIX)
+    if base_name not in variants:
+        known = sorted([*variants, *(f"{name}{INT8_SUFFIX}" for name in variants)])
+        raise RuntimeError(
+            f"SAM2_MODEL '{default_name}' is not a known model. Known models: {', '.join(known)}."
+        )
+    default = variants[base_name]
 
     env_config_path = os.environ.get("SAM2_CONFIG")
     env_checkpoint_path = os.environ.get("SAM2_CHECKPOINT")
-    default_device = "cuda" if torch.cuda.is_available() else "cpu"
 
     if env_config_path and Path(env_config_path).exists():
         config_path = env_config_path
@@ -622,9 +1779,9 @@ def resolve_sam2_config() -> Sam2Config:
         print(
             f"[WARN] SAM2_CONFIG was set but not found at '{env_config_path}'. Falling back to auto-detected config."
         )
-        config_path = str(default_config)
+        config_path = default.config_path
     else:
-        config_path = str(default_config)
+        config_path = default.config_path
 
     if env_checkpoint_path and Path(env_checkpoint_path).exists():
         checkpoint_path = env_checkpoint_path
@@ -632,30 +1789,1649 @@ def resolve_sam2_config() -> Sam2Config:
         print(
             f"[WARN] SAM2_CHECKPOINT was set but not found at '{env_checkpoint_path}'. Falling back to default checkpoint path."
         )
-        checkpoint_path = str(default_checkpoint)
+        checkpoint_path = default.checkpoint_path
     else:
-        checkpoint_path = str(default_checkpoint)
-
-    device = os.environ.get("SAM2_DEVICE", default_device)
+        checkpoint_path = default.checkpoint_path
 
     if not Path(config_path).exists():
         raise RuntimeError(
-            f"SAM2 config not found at '{config_path}'. Set SAM2_CONFIG to a valid sam2.1_hiera_s.yaml path."
+            f"SAM2 config not found at '{config_path}'. Set SAM2_CONFIG to a valid {Path(config_path).name} path."
         )
     if not Path(checkpoint_path).exists():
         raise RuntimeError(
-            f"SAM2 checkpoint not found at '{checkpoint_path}'. Put sam2.1_hiera_small.pt in tools/sam2-local/checkpoints or set SAM2_CHECKPOINT."
+            f"SAM2 checkpoint not found at '{checkpoint_path}'. Put {Path(checkpoint_path).name} in tools/sam2-local/checkpoints or set SAM2_CHECKPOINT."
         )
 
-    return Sam2Config(
+    variants[base_name] = Sam2Config(
+        name=base_name,
         config_path=config_path,
         checkpoint_path=checkpoint_path,
         device=device,
     )
 
+    # Every variant also has an int8 sibling. Dynamic quantization only has CPU kernels.
+    for name, cfg in list(variants.items()):
+        int8_name = f"{name}{INT8_SUFFIX}"
+        variants[int8_name] = replace(cfg, name=int8_name, device="cpu", quantization="int8")
+    return variants, default_name
+
+
+def quantize_int8(model: Any) -> Any:
+    import torch
+
+    # Weights of every nn.Linear (Hiera attention/MLP blocks, decoder transformer) become int8;
+    # activations are quantized per batch at runtime. Convolutions and norms stay fp32.
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def model_nbytes(model: Any) -> int:
+    # state_dict() rather than parameters(): quantized Linear weights are packed
+    # (weight, bias) tuples that parameters() does not report.
+    total = 0
+    for value in model.state_dict().values():
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if hasattr(tensor, "element_size"):
+                total += int(tensor.element_size() * tensor.nelement())
+    return total
+
+
+@dataclass
+class LoadedModel:
+    cfg: Sam2Config
+    model: Any
+    model_id: str
+    nbytes: int
+    source: str = "checkpoint"
+    timings: dict[str, float] | None = None
+
+
+def resolve_snapshot_dir() -> Path | None:
+    if not env_flag("SAM2_SNAPSHOT", False):
+        return None
+    raw = os.environ.get("SAM2_SNAPSHOT_DIR", "").strip()
+    return Path(raw) if raw else Path(__file__).resolve().parent / "snapshots"
+
+
+def snapshot_path(snapshot_dir: Path, cfg: Sam2Config) -> Path:
+    # A snapshot is a pickled module graph, so it is only valid for the torch and sam2 versions
+    # that wrote it, on top of the checkpoint, config, device and quantization in model_identity.
+    import torch
+
+    try:
+        sam2_version = importlib.metadata.version("sam2")
+    except importlib.metadata.PackageNotFoundError:
+        sam2_version = "unknown"
+    raw = f"{model_identity(cfg)}|torch={torch.__version__}|sam2={sam2_version}"
+    digest = hashlib.blake2b(raw.encode("utf-8"), digest_size=12).hexdigest()
+    return snapshot_dir / f"{cfg.name}-{digest}.pt"
+
+
+def load_snapshot(path: Path, device: str) -> Any:
+    import torch
+
+    # mmap=True maps the tensor storages from the file instead of reading them, so weights are
+    # paged in on first use. The snapshot is written by this server into its own directory,
+    # which is why unpickling the module graph (weights_only=False) is acceptable here.
+    model = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    if device != "cpu":
+        model = model.to(device)
+    return model.eval()
+
+
+def save_snapshot(model: Any, path: Path) -> None:
+    import torch
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        torch.save(model, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception as exc:
+        tmp_path.unlink(missing_ok=True)
+        print(f"[WARN] Could not write SAM2 model snapshot '{path}': {exc}")
+
+
+def load_model(cfg: Sam2Config) -> LoadedModel:
+    from sam2.build_sam import _load_checkpoint, build_sam2
+
+    snapshot_dir = resolve_snapshot_dir()
+    snapshot = snapshot_path(snapshot_dir, cfg) if snapshot_dir is not None else None
+    if snapshot is not None and snapshot.exists():
+        started = time.perf_counter()
+        try:
+            model = load_snapshot(snapshot, cfg.device)
+        except Exception as exc:
+            print(f"[WARN] Ignoring unreadable SAM2 model snapshot '{snapshot}': {exc}")
+        else:
+            return LoadedModel(
+                cfg=cfg,
+                model=model,
+                model_id=model_identity(cfg),
+                nbytes=model_nbytes(model),
+                source="snapshot",
+                timings={"build_s": 0.0, "load_s": round(time.perf_counter() - started, 3)},
+            )
+
+    # build_sam2() without a checkpoint only composes the config and builds the module graph,
+    # so the two halves of the cold start can be timed separately.
+    started = time.perf_counter()
+    model = build_sam2(hydra_config_name(cfg.config_path), None, device=cfg.device)
+    built = time.perf_counter()
+    _load_checkpoint(model, cfg.checkpoint_path)
+    if cfg.quantization == "int8":
+        model = quantize_int8(model)
+    loaded = time.perf_counter()
+    timings = {"build_s": round(built - started, 3), "load_s": round(loaded - built, 3)}
+    if snapshot is not None:
+        save_snapshot(model, snapshot)
+        timings["snapshot_save_s"] = round(time.perf_counter() - loaded, 3)
+    return LoadedModel(
+        cfg=cfg,
+        model=model,
+        model_id=model_identity(cfg),
+        nbytes=model_nbytes(model),
+        timings=timings,
+    )
+
+
+class ModelRegistry:
+    # Named SAM2 variants, loaded on first use and kept in an LRU bounded by parameter memory.
+    # The most recently requested model is never evicted, even if it alone exceeds the budget.
+    def __init__(self, variants: dict[str, Sam2Config], default_name: str, max_bytes: int) -> None:
+        self.variants = variants
+        self.default_name = default_name
+        self.max_bytes = max_bytes
+        self._loaded: OrderedDict[str, LoadedModel] = OrderedDict()
+        self._load_locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, name: str | None) -> Sam2Config:
+        name = name or self.default_name
+        cfg = self.variants.get(name)
+        if cfg is None:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown model '{name}'. Known models: {', '.join(sorted(self.variants))}",
+            )
+        if not cfg.installed:
+            raise HTTPException(
+                status_code=400,
+                detail=(
+                    f"Model '{name}' is not installed. Expected config at '{cfg.config_path}' "
+                    f"and checkpoint at '{cfg.checkpoint_path}'."
+                ),
+            )
+        return cfg
+
+    def adopt(self, loaded: LoadedModel) -> None:
+        # Registers a model built elsewhere, e.g. shared weights handed to a worker process.
+        with self._lock:
+            self._loaded[loaded.cfg.name] = loaded
+            self._evict(keep=loaded.cfg.name)
+
+    def get(self, name: str | None = None) -> LoadedModel:
+        cfg = self.resolve(name)
+        with self._lock:
+            loaded = self._loaded.get(cfg.name)
+            if loaded is not None:
+                self._loaded.move_to_end(cfg.name)
+                return loaded
+            load_lock = self._load_locks.setdefault(cfg.name, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                loaded = self._loaded.get(cfg.name)
+                if loaded is not None:
+                    self._loaded.move_to_end(cfg.name)
+                    return loaded
+            print(f"[INFO] Loading SAM2 model '{cfg.name}' from '{cfg.checkpoint_path}'")
+            try:
+                loaded = load_model(cfg)
+            except Exception as exc:
+                raise HTTPException(
+                    status_code=500, detail=f"Failed to load SAM2 model '{cfg.name}': {exc}"
+                ) from exc
+            timings = loaded.timings or {}
+            print(
+                f"[INFO] Loaded SAM2 model '{cfg.name}' from {loaded.source} "
+                f"(build {timings.get('build_s', 0.0):.2f}s, load {timings.get('load_s', 0.0):.2f}s)"
+            )
+            with self._lock:
+                self._loaded[cfg.name] = loaded
+                self._evict(keep=cfg.name)
+        return loaded
+
+    def _evict(self, keep: str) -> None:
+        total = sum(m.nbytes for m in self._loaded.values())
+        for name in list(self._loaded.keys()):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            total -= self._loaded.pop(name).nbytes
+            print(f"[INFO] Unloaded SAM2 model '{name}' to stay within the model memory budget")
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            models = dict(self._loaded)
+        loaded = {name: m.nbytes for name, m in models.items()}
+        return {
+            "default": self.default_name,
+            "max_bytes": self.max_bytes,
+            "loaded_bytes": sum(loaded.values()),
+            "models": [
+                {
+                    "name": name,
+                    "device": cfg.device,
+                    "quantization": cfg.quantization,
+                    "installed": cfg.installed,
+                    "loaded": name in loaded,
+                    "bytes": loaded.get(name, 0),
+                    "source": models[name].source if name in models else None,
+                    "timings": models[name].timings if name in models else None,
+                    "config": cfg.config_path,
+                    "checkpoint": cfg.checkpoint_path,
+                }
+                for name, cfg in self.variants.items()
+            ],
+        }
+
+
+def env_int_list(name: str, default: str) -> list[int]:
+    raw = os.environ.get(name, "").strip() or default
+    values: list[int] = []
+    for part in raw.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            values.append(int(part))
+        except ValueError:
+            print(f"[WARN] Ignoring non-integer value '{part}' in {name}.")
+    return values
+
+
+def synthetic_sprite(size: int) -> Image.Image:
+    # A flat-colored figure on a transparent background, roughly the shape of a game character.
+    image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+
+    def box(x0: float, y0: float, x1: float, y1: float) -> list[int]:
+        return [int(x0 * size), int(y0 * size), int(x1 * size), int(y1 * size)]
+
+    draw.ellipse(box(0.38, 0.05, 0.62, 0.27), fill=(236, 196, 160, 255))
+    draw.rectangle(box(0.34, 0.27, 0.66, 0.60), fill=(52, 96, 196, 255))
+    draw.rectangle(box(0.18, 0.29, 0.33, 0.56), fill=(236, 196, 160, 255))
+    draw.rectangle(box(0.67, 0.29, 0.82, 0.56), fill=(236, 196, 160, 255))
+    draw.rectangle(box(0.36, 0.60, 0.48, 0.95), fill=(64, 64, 72, 255))
+    draw.rectangle(box(0.52, 0.60, 0.64, 0.95), fill=(64, 64, 72, 255))
+    draw.line(box(0.82, 0.30, 0.95, 0.10), fill=(200, 200, 210, 255), width=max(2, size // 64))
+    return image
+
+
+def fit_through_origin(xs: list[float], ys: list[float]) -> float:
+    denominator = sum(x * x for x in xs)
+    if denominator <= 0:
+        return 0.0
+    return sum(x * y for x, y in zip(xs, ys)) / denominator
+
+
+def fit_point_costs(points: list[float], megapixels: list[float], ms: list[float]) -> tuple[float, float]:
+    # Least-squares ms ~ points * (per_point + per_point_megapixel * megapixels), both terms kept
+    # non-negative. With a single image size the two can't be told apart and all of it goes to
+    # per_point.
+    scaled = [p * mp for p, mp in zip(points, megapixels)]
+    a11 = sum(p * p for p in points)
+    a12 = sum(p * q for p, q in zip(points, scaled))
+    a22 = sum(q * q for q in scaled)
+    b1 = sum(p * y for p, y in zip(points, ms))
+    b2 = sum(q * y for q, y in zip(scaled, ms))
+    det = a11 * a22 - a12 * a12
+    if det <= 1e-9 * max(1.0, a11 * a22):
+        return fit_through_origin(points, ms), 0.0
+    per_point = (b1 * a22 - b2 * a12) / det
+    per_point_megapixel = (a11 * b2 - a12 * b1) / det
+    if per_point_megapixel < 0:
+        return fit_through_origin(points, ms), 0.0
+    if per_point < 0:
+        return 0.0, fit_through_origin(scaled, ms)
+    return per_point, per_point_megapixel
+
+
+def run_warmup(
+    model: Any,
+    sizes: list[int],
+    points_per_side_values: list[int],
+    iou_floor: float,
+    stability_floor: float,
+) -> dict[str, Any]:
+    import torch
+
+    started = time.perf_counter()
+    # Private cache: the encoder runs once per size, and warmup never touches the request caches.
+    embedding_cache = ByteBudgetLRU(1024 * 1024 * 1024)
+    samples: list[dict[str, Any]] = []
+    encoder_runs: list[float] = []
+    for size in sizes:
+        image = synthetic_sprite(size)
+        rgb = pil_to_rgb_numpy(image)
+        image_key = f"warmup:{image_digest(rgb)}"
+        for points_per_side in points_per_side_values:
+            for use_m2m in (False, True):
+                req = PartsRequest(image="", points_per_side=points_per_side, use_m2m=use_m2m)
+                generator = build_generator(model, req)
+                timings: dict[str, float] = {}
+                # The same floors generate_proposals applies, so decode times match real requests.
+                proposals = decode_proposals(
+                    generator,
+                    rgb,
+                    image_key,
+                    embedding_cache,
+                    min(iou_floor, req.pred_iou_thresh),
+                    min(stability_floor, req.stability_score_thresh),
+                    timings=timings,
+                )
+                if len(encoder_runs) < sizes.index(size) + 1:
+                    encoder_runs.append(timings["encode_ms"])
+                post_started = time.perf_counter()
+                masks = select_proposals(
+                    proposals,
+                    req.pred_iou_thresh,
+                    req.stability_score_thresh,
+                    generator.box_nms_thresh,
+                )
+                opaque_mask = alpha_opaque_mask(image)
+                character_mask, part_masks, labeled_regions = build_part_masks(
+                    masks, size, size, req.max_regions, opaque_mask
+                )
+                build_parts_preview(image, character_mask, part_masks)
+                build_regions_preview(image, character_mask, labeled_regions)
+                samples.append(
+                    {
+                        "size": size,
+                        "points_per_side": points_per_side,
+                        "use_m2m": use_m2m,
+                        "encode_ms": round(timings["encode_ms"], 2),
+                        "decode_ms": round(timings["decode_ms"], 2),
+                        "postprocess_ms": round((time.perf_counter() - post_started) * 1000.0, 2),
+                    }
+                )
+                print(
+                    f"[INFO] Warmup {size}px points_per_side={points_per_side} m2m={use_m2m}: "
+                    f"encode {timings['encode_ms']:.0f}ms, decode {timings['decode_ms']:.0f}ms"
+                )
+
+    plain = {(s["size"], s["points_per_side"]): s["decode_ms"] for s in samples if not s["use_m2m"]}
+    refined = {(s["size"], s["points_per_side"]): s["decode_ms"] for s in samples if s["use_m2m"]}
+    m2m_ratios = [refined[key] / plain[key] for key in plain if plain[key] > 0 and key in refined]
+    plain_samples = [s for s in samples if not s["use_m2m"]]
+    # Every mask is upsampled to the image size and scored and RLE-encoded there, so the decode
+    # cost per point grows with the image area on top of a fixed part.
+    per_point, per_point_megapixel = fit_point_costs(
+        [float(s["points_per_side"] ** 2) for s in plain_samples],
+        [s["size"] * s["size"] / 1_000_000 for s in plain_samples],
+        [s["decode_ms"] for s in plain_samples],
+    )
+    model_costs = {
+        "encode_ms": round(float(np.median(encoder_runs)), 2) if encoder_runs else 0.0,
+        "decode_ms_per_point": round(per_point, 4),
+        "decode_ms_per_point_megapixel": round(per_point_megapixel, 4),
+        "m2m_factor": round(float(np.median(m2m_ratios)), 3) if m2m_ratios else 2.0,
+        "postprocess_ms_per_megapixel": round(
+            fit_through_origin(
+                [s["size"] * s["size"] / 1_000_000 for s in samples],
+                [s["postprocess_ms"] for s in samples],
+            ),
+            2,
+        ),
+    }
+    return {
+        "host": {
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "device": str(next(model.parameters()).device),
+        },
+        "warmup_s": round(time.perf_counter() - started, 2),
+        "samples": samples,
+        "cost_model": model_costs,
+    }
+
+
+def estimate_request_ms(
+    calibration: dict[str, Any],
+    width: int,
+    height: int,
+    points_per_side: int,
+    use_m2m: bool,
+) -> float:
+    costs = calibration["cost_model"]
+    megapixels = width * height / 1_000_000
+    per_point = costs["decode_ms_per_point"] + costs["decode_ms_per_point_megapixel"] * megapixels
+    decode_ms = per_point * points_per_side * points_per_side
+    if use_m2m:
+        decode_ms *= costs["m2m_factor"]
+    post_ms = costs["postprocess_ms_per_megapixel"] * megapixels
+    return costs["encode_ms"] + decode_ms + post_ms
+
+
+def run_inference(
+    registry: ModelRegistry,
+    model_cfg: Sam2Config,
+    rgb: np.ndarray,
+    req: SegmentRequest,
+    caches: Sam2Caches,
+    inference_id: str,
+    precision: str,
+    features: dict[str, Any] | None = None,
+    control: RunControl | None = None,
+) -> ProposalSet:
+    # Work that waited in the executor queue may have been abandoned in the meantime.
+    if control is not None:
+        control.checkpoint()
+    loaded = registry.get(model_cfg.name)
+    generator = build_generator(loaded.model, req)
+    return generate_proposals(generator, rgb, req, caches, inference_id, precision, features, control)
+
+
+def encode_batch(loaded: LoadedModel, precision: str, images: list[np.ndarray]) -> list[dict[str, Any]]:
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    predictor = SAM2ImagePredictor(loaded.model)
+    with inference_precision(predictor.device, precision):
+        if len(images) == 1:
+            predictor.set_image(images[0])
+            return [predictor._features]
+        # Every image is resized to the model's input size, so frames of any size batch together.
+        predictor.set_image_batch(images)
+    batched = predictor._features
+    # clone() so a cached embedding does not keep the whole batch alive.
+    return [
+        {
+            "image_embed": batched["image_embed"][idx : idx + 1].clone(),
+            "high_res_feats": [feat[idx : idx + 1].clone() for feat in batched["high_res_feats"]],
+        }
+        for idx in range(len(images))
+    ]
+
+
+@dataclass(eq=False)
+class EncodeItem:
+    key: str
+    loaded: LoadedModel
+    precision: str
+    rgb: np.ndarray
+    future: Future[Any]
+
+
+class EncoderBatcher:
+    # Image encoder passes for the same model and precision that arrive within window_s of each
+    # other run as one batched forward on an inference slot. Mask decoding stays per request.
+    def __init__(self, executor: InferenceExecutor, window_s: float, max_batch: int) -> None:
+        self.executor = executor
+        self.window_s = window_s
+        self.max_batch = max_batch
+        self._pending: list[EncodeItem] = []
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._batches = 0
+        self._images = 0
+        self._largest = 0
+
+    def encode(
+        self, loaded: LoadedModel, precision: str, rgb: np.ndarray, control: RunControl | None = None
+    ) -> dict[str, Any]:
+        item = EncodeItem(
+            key=inference_identity(loaded.model_id, precision),
+            loaded=loaded,
+            precision=precision,
+            rgb=rgb,
+            future=Future(),
+        )
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._collect, name="sam2-encoder-batcher", daemon=True
+                )
+                self._thread.start()
+            self._pending.append(item)
+            self._cond.notify()
+        if control is not None:
+            while not item.future.done():
+                wait([item.future], timeout=CANCEL_POLL_S)
+                try:
+                    control.checkpoint()
+                except HTTPException:
+                    # Still waiting for its window: drop it from the next batch. Once its batch
+                    # has been submitted the features are simply not collected.
+                    with self._cond:
+                        if item in self._pending:
+                            self._pending.remove(item)
+                    raise
+        return item.future.result()
+
+    def _collect(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key = self._pending[0].key
+                deadline = time.perf_counter() + self.window_s
+                while True:
+                    batch = [item for item in self._pending if item.key == key][: self.max_batch]
+                    remaining = deadline - time.perf_counter()
+                    if len(batch) >= self.max_batch or remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                self._pending = [item for item in self._pending if item not in batch]
+                self._batches += 1
+                self._images += len(batch)
+                self._largest = max(self._largest, len(batch))
+
+            # The batch waits for a slot like any request; more items queue up meanwhile.
+            future = self.executor.submit(
+                encode_batch, batch[0].loaded, batch[0].precision, [item.rgb for item in batch]
+            )
+            future.add_done_callback(lambda done, batch=batch: self._deliver(batch, done))
+
+    @staticmethod
+    def _deliver(batch: list[EncodeItem], done: Future[Any]) -> None:
+        error = done.exception()
+        if error is not None:
+            for item in batch:
+                item.future.set_exception(error)
+            return
+        for item, features in zip(batch, done.result()):
+            item.future.set_result(features)
+
+    def stats(self) -> dict[str, Any]:
+        with self._cond:
+            return {
+                "window_ms": round(self.window_s * 1000.0, 1),
+                "max_batch": self.max_batch,
+                "pending": len(self._pending),
+                "batches": self._batches,
+                "images": self._images,
+                "mean_batch": round(self._images / max(self._batches, 1), 2),
+                "largest_batch": self._largest,
+            }
+
+
+# How often a waiting request looks for a disconnected client or a cancelled run.
+CANCEL_POLL_S = 0.25
+# How often the worker pool looks for worker processes that have died.
+WORKER_CHECK_S = 1.0
+
+
+class RunControl:
+    # Per-request view into a model run. The pipeline reports its stage and progress here, and
+    # callers such as the jobs API read them. Cancellation is cooperative: cancel() or a passed
+    # deadline only takes effect at the next checkpoint(), which the pipeline calls between point
+    # batches and post-processing stages. A listener, such as the streaming parts endpoint,
+    # receives every progress report and partial result as an event.
+    def __init__(self, deadline: float | None = None) -> None:
+        self.stage = "queued"
+        self.progress = 0.0
+        # time.time() based so it means the same thing inside worker processes.
+        self.deadline = deadline
+        self.cancel_reason: str | None = None
+        self.listener: Callable[[str, dict[str, Any]], None] | None = None
+
+    @classmethod
+    def for_request(cls, req: SegmentRequest) -> RunControl:
+        deadline = time.time() + req.deadline_ms / 1000.0 if req.deadline_ms is not None else None
+        return cls(deadline)
+
+    def report(self, stage: str, progress: float, **detail: Any) -> None:
+        self.stage = stage
+        self.progress = max(self.progress, min(1.0, progress))
+        self.emit("progress", {"stage": stage, "progress": round(self.progress, 3), **detail})
+
+    def emit(self, event: str, data: dict[str, Any]) -> None:
+        if self.listener is not None:
+            self.listener(event, data)
+
+    def cancel(self, reason: str) -> None:
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+
+    def checkpoint(self) -> None:
+        if self.cancel_reason is None and self.deadline is not None and time.time() > self.deadline:
+            self.cancel_reason = "deadline exceeded"
+        if self.cancel_reason is None:
+            return
+        # 499 is the de facto "client closed request" status; nobody is left to read it.
+        status_code = 504 if self.cancel_reason == "deadline exceeded" else 499
+        raise HTTPException(status_code=status_code, detail=f"SAM2 run stopped: {self.cancel_reason}")
+
+
+class WorkerRunControl(RunControl):
+    # RunControl inside a worker process. The parent cancels a task by writing its id into the
+    # worker's shared cancel slot.
+    def __init__(self, deadline: float | None, cancel_slot: Any, task_id: int) -> None:
+        super().__init__(deadline)
+        self._cancel_slot = cancel_slot
+        self._task_id = task_id
+
+    def checkpoint(self) -> None:
+        if self._cancel_slot.value == self._task_id:
+            self.cancel("cancelled by server")
+        super().checkpoint()
+
+
+class InferenceExecutor:
+    # Model work runs on a fixed number of slots instead of FastAPI's request threadpool. Each slot
+    # thread gets a torch intra-op thread budget, so slots * threads_per_slot stays within the
+    # cores and concurrent requests queue here instead of fighting over them.
+    def __init__(self, slots: int, threads_per_slot: int) -> None:
+        self.slots = slots
+        self.threads_per_slot = threads_per_slot
+        self._pool = ThreadPoolExecutor(
+            max_workers=slots, thread_name_prefix="sam2-inference", initializer=self._init_thread
+        )
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._wait_s = 0.0
+        self._busy_s = 0.0
+        self._started_at = time.perf_counter()
+
+    def _init_thread(self) -> None:
+        import torch
+
+        torch.set_num_threads(self.threads_per_slot)
+
+    def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return self.submit(fn, *args, **kwargs).result()
+
+    def submit(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future[Any]:
+        submitted = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+
+        def task() -> Any:
+            started = time.perf_counter()
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._wait_s += started - submitted
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                    self._busy_s += time.perf_counter() - started
+
+        return self._pool.submit(task)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            elapsed = max(time.perf_counter() - self._started_at, 1e-9)
+            return {
+                "slots": self.slots,
+                "threads_per_slot": self.threads_per_slot,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "mean_wait_ms": round(self._wait_s * 1000.0 / max(self._completed, 1), 1),
+                "utilization": round(self._busy_s / (elapsed * self.slots), 3),
+            }
+
+
+def build_inference_executor() -> InferenceExecutor:
+    cores = os.cpu_count() or 1
+    slots = max(1, env_int("SAM2_INFERENCE_SLOTS", 1))
+    threads_per_slot = env_int("SAM2_INFERENCE_THREADS", 0)
+    if threads_per_slot <= 0:
+        threads_per_slot = max(1, cores // slots)
+    if slots * threads_per_slot > cores:
+        print(
+            f"[WARN] {slots} inference slots x {threads_per_slot} threads oversubscribes {cores} cores."
+        )
+    return InferenceExecutor(slots, threads_per_slot)
+
+
+def warn_if_bf16_emulated(precision: str, device: str) -> None:
+    if precision == "bf16" and device == "cpu" and not cpu_bf16_supported():
+        print(
+            "[WARN] SAM2_PRECISION=bf16 but this CPU has no native bf16 support (AVX-512 BF16/AMX). "
+            "bf16 inference will likely be slower than fp32."
+        )
+
+
+def warmup_settings() -> tuple[list[int], list[int]] | None:
+    warmup_sizes = [s for s in env_int_list("SAM2_WARMUP_SIZES", "256,512") if s >= 16]
+    warmup_points = [p for p in env_int_list("SAM2_WARMUP_POINTS", "8,16") if 8 <= p <= 128]
+    if env_flag("SAM2_WARMUP", True) and warmup_sizes and warmup_points:
+        return warmup_sizes, warmup_points
+    return None
+
+
+def warmup_model(
+    name: str,
+    loaded: LoadedModel,
+    caches: Sam2Caches,
+    sizes: list[int],
+    points_per_side_values: list[int],
+) -> dict[str, Any] | None:
+    try:
+        warmup = run_warmup(
+            loaded.model,
+            sizes,
+            points_per_side_values,
+            caches.proposal_iou_floor,
+            caches.proposal_stability_floor,
+        )
+        return {"model": name, **warmup}
+    except Exception as exc:
+        # A failed warmup only costs the calibration data, not the server.
+        print(f"[WARN] SAM2 warmup failed: {exc}")
+        return None
+
+
+def share_model_weights(registry: ModelRegistry, name: str) -> LoadedModel | None:
+    cfg = registry.resolve(name)
+    if cfg.device != "cpu" or cfg.quantization != "none":
+        # CUDA tensors would need IPC handles per device and packed int8 weights are pickled by
+        # value, so neither benefits; those workers load their own copy.
+        print(f"[WARN] SAM2_SHARED_WEIGHTS only applies to fp32 CPU models, not '{name}' on {cfg.device}.")
+        return None
+    loaded = registry.get(name)
+    loaded.model.share_memory()
+    print(f"[INFO] Shared {loaded.nbytes / (1024 * 1024):.0f} MB of '{name}' weights with the workers")
+    return loaded
+
+
+def partition_cpus(count: int) -> list[list[int]]:
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = list(range(os.cpu_count() or 1))
+    size = max(1, len(cpus) // count)
+    return [[cpus[(idx * size + offset) % len(cpus)] for offset in range(size)] for idx in range(count)]
+
+
+def worker_main(
+    worker_id: int,
+    cpus: list[int],
+    tasks: Any,
+    results: Any,
+    cancel_slot: Any,
+    precision: str,
+    worker_count: int,
+    shared_model: LoadedModel | None = None,
+) -> None:
+    # Entry point of an inference worker process: one model replica pinned to its own cores,
+    # pulling tasks from its own queue. With shared_model the default model's weights live in
+    # shared memory owned by the parent instead of a private copy.
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        import torch
+
+        torch.set_num_threads(len(cpus))
+        variants, default_name = resolve_model_variants()
+        registry = ModelRegistry(
+            variants, default_name, env_megabytes("SAM2_MODEL_MEMORY_MB", 2048)
+        )
+        if shared_model is not None:
+            registry.adopt(shared_model)
+        default_model = registry.get(default_name)
+        caches = build_caches(default_model.cfg.device, share=worker_count)
+        if worker_id == 0:
+            warn_if_bf16_emulated(precision, default_model.cfg.device)
+        warmup = warmup_settings()
+        calibration = (
+            warmup_model(default_name, default_model, caches, *warmup) if warmup else None
+        )
+    except Exception as exc:
+        results.put(("failed", worker_id, None, str(exc)))
+        return
+    results.put(("ready", worker_id, None, calibration))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, model_cfg, rgb, req, inference_id, task_precision, deadline = task
+        results.put(("started", worker_id, task_id, None))
+        control = WorkerRunControl(deadline, cancel_slot, task_id)
+        try:
+            # The selected proposals go back as RLE, a small fraction of their full-size masks,
+            # and are decoded by the requesting process.
+            proposals = run_inference(
+                registry, model_cfg, rgb, req, caches, inference_id, task_precision, control=control
+            )
+        except HTTPException as exc:
+            results.put(("error", worker_id, task_id, (exc.status_code, exc.detail)))
+        except Exception as exc:
+            results.put(("error", worker_id, task_id, (500, f"SAM2 inference failed: {exc}")))
+        else:
+            results.put(("done", worker_id, task_id, proposals))
+
+
+def process_memory(pid: int) -> dict[str, float] | None:
+    # Linux only. PSS charges each shared page to every process mapping it in equal parts.
+    try:
+        text = Path(f"/proc/{pid}/smaps_rollup").read_text(encoding="utf-8")
+    except OSError:
+        return None
+    kb: dict[str, int] = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[2] == "kB":
+            kb[parts[0].rstrip(":")] = int(parts[1])
+
+    def mb(*keys: str) -> float:
+        return round(sum(kb.get(key, 0) for key in keys) / 1024.0, 1)
+
+    return {
+        "rss_mb": mb("Rss"),
+        "pss_mb": mb("Pss"),
+        "shared_mb": mb("Shared_Clean", "Shared_Dirty"),
+        "private_mb": mb("Private_Clean", "Private_Dirty"),
+        "swap_mb": mb("Swap"),
+    }
+
+
+@dataclass
+class WorkerState:
+    worker_id: int
+    cpus: list[int]
+    process: Any = None
+    tasks: Any = None
+    cancel_slot: Any = None
+    ready: bool = False
+    started_at: float = 0.0
+    current_task: int | None = None
+    task_started_at: float = 0.0
+    completed: int = 0
+    failed: int = 0
+    busy_s: float = 0.0
+    restarts: int = 0
+
+
+class WorkerPool:
+    # Supervisor for SAM2_WORKERS inference processes. Each worker has its own task queue, and a
+    # request goes to the worker picked by its image digest, so repeats and threshold sweeps of
+    # an image hit the embedding and proposal caches of the one worker that holds them. A
+    # dispatcher thread matches results back to the waiting request threads and restarts
+    # workers that die.
+    def __init__(self, count: int, precision: str, shared_model: LoadedModel | None = None) -> None:
+        import torch.multiprocessing
+
+        self.precision = precision
+        self.shared_model = shared_model
+        self.calibration: dict[str, Any] | None = None
+        self.error: str | None = None
+        # torch's context pickles tensors in shared memory as handles, so shared weights reach
+        # the workers without being copied.
+        self._ctx = torch.multiprocessing.get_context("spawn")
+        self._results = self._ctx.Queue()
+        self._workers = [WorkerState(idx, cpus) for idx, cpus in enumerate(partition_cpus(count))]
+        for worker in self._workers:
+            worker.tasks = self._ctx.Queue()
+        self._pending: dict[int, Future[Any]] = {}
+        # Tasks put on a worker's queue that it has not reported as started, by task id: the
+        # worker they went to and the task itself, to requeue them if that worker dies.
+        self._queued: dict[int, tuple[int, tuple[Any, ...]]] = {}
+        # Bound on how long a request without a deadline of its own waits for its worker.
+        self.task_timeout_s = env_float("SAM2_WORKER_TIMEOUT_SECONDS", 600.0)
+        # Abandoned tasks whose worker still has to be told to stop.
+        self._cancelled: set[int] = set()
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopping = False
+        self._dispatcher: threading.Thread | None = None
+
+    def start(self) -> None:
+        for worker in self._workers:
+            self._spawn(worker)
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="sam2-worker-dispatch", daemon=True
+        )
+        self._dispatcher.start()
+
+    def _spawn(self, worker: WorkerState) -> None:
+        worker.ready = False
+        worker.current_task = None
+        worker.started_at = time.time()
+        worker.cancel_slot = self._ctx.Value("q", -1)
+        worker.process = self._ctx.Process(
+            target=worker_main,
+            args=(
+                worker.worker_id,
+                worker.cpus,
+                worker.tasks,
+                self._results,
+                worker.cancel_slot,
+                self.precision,
+                len(self._workers),
+                self.shared_model,
+            ),
+            name=f"sam2-worker-{worker.worker_id}",
+            daemon=True,
+        )
+        worker.process.start()
+        print(f"[INFO] Started SAM2 worker {worker.worker_id} (pid {worker.process.pid}, cpus {worker.cpus})")
+
+    def wait_ready(self) -> None:
+        self._ready.wait()
+        if self.error is not None:
+            raise RuntimeError(self.error)
+
+    def infer(
+        self,
+        model_cfg: Sam2Config,
+        rgb: np.ndarray,
+        req: SegmentRequest,
+        inference_id: str,
+        precision: str,
+        control: RunControl | None = None,
+    ) -> list[dict[str, Any]]:
+        # Never wait unbounded on another process, whatever happens to it. The worker gets the
+        # same limit, so it stops too.
+        deadline = control.deadline if control is not None else None
+        give_up_at = deadline if deadline is not None else time.time() + self.task_timeout_s
+        future: Future[Any] = Future()
+        task_id = next(self._task_ids)
+        task = (task_id, model_cfg, rgb, req, inference_id, precision, give_up_at)
+        worker = self._workers[int(image_digest(rgb)[:8], 16) % len(self._workers)]
+        with self._lock:
+            self._pending[task_id] = future
+            self._queued[task_id] = (worker.worker_id, task)
+            worker.tasks.put(task)
+        while not future.done():
+            wait([future], timeout=CANCEL_POLL_S)
+            try:
+                if control is not None:
+                    control.checkpoint()
+                if not future.done() and time.time() > give_up_at:
+                    raise HTTPException(status_code=504, detail="SAM2 run stopped: deadline exceeded")
+            except HTTPException:
+                self._cancel(task_id)
+                raise
+        return proposal_masks(future.result())
+
+    def _cancel(self, task_id: int) -> None:
+        with self._lock:
+            self._pending.pop(task_id, None)
+            if task_id not in self._queued:
+                self._cancelled.add(task_id)
+            for worker in self._workers:
+                if worker.current_task == task_id:
+                    worker.cancel_slot.value = task_id
+
+    def _resolve(self, task_id: int, result: Any = None, error: BaseException | None = None) -> None:
+        with self._lock:
+            future = self._pending.pop(task_id, None)
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _dispatch(self) -> None:
+        # Liveness is checked on a timer, not only when the queue goes quiet: under steady traffic
+        # from the other workers a dead one would never be noticed and its request never resolved.
+        next_check = time.perf_counter() + WORKER_CHECK_S
+        while not self._stopping:
+            try:
+                self._handle(self._results.get(timeout=WORKER_CHECK_S))
+            except queue.Empty:
+                pass
+            if time.perf_counter() < next_check:
+                continue
+            # Whatever a worker sent before exiting is handled before it is declared dead.
+            try:
+                while True:
+                    self._handle(self._results.get_nowait())
+            except queue.Empty:
+                pass
+            self._check_workers()
+            next_check = time.perf_counter() + WORKER_CHECK_S
+
+    def _handle(self, message: tuple[str, int, int | None, Any]) -> None:
+        kind, worker_id, task_id, payload = message
+        worker = self._workers[worker_id]
+        now = time.perf_counter()
+        if kind == "ready":
+            worker.ready = True
+            if worker_id == 0 and self.calibration is None:
+                self.calibration = payload
+            if all(w.ready for w in self._workers):
+                self._ready.set()
+        elif kind == "failed":
+            self.error = f"SAM2 worker {worker_id} failed to load: {payload}"
+            self._ready.set()
+        elif kind == "started":
+            with self._lock:
+                worker.current_task = task_id
+                self._queued.pop(task_id, None)
+                if task_id in self._cancelled or task_id not in self._pending:
+                    self._cancelled.add(task_id)
+                    worker.cancel_slot.value = task_id
+            worker.task_started_at = now
+        else:
+            with self._lock:
+                worker.current_task = None
+                self._cancelled.discard(task_id)
+            worker.busy_s += now - worker.task_started_at
+            if kind == "done":
+                worker.completed += 1
+                self._resolve(task_id, result=payload)
+            else:
+                worker.failed += 1
+                status_code, detail = payload
+                self._resolve(task_id, error=HTTPException(status_code=status_code, detail=detail))
+
+    def _check_workers(self) -> None:
+        for worker in self._workers:
+            if worker.process is None or worker.process.is_alive() or self._stopping:
+                continue
+            if not self._ready.is_set():
+                self.error = f"SAM2 worker {worker.worker_id} exited during startup"
+                self._ready.set()
+                return
+            print(
+                f"[WARN] SAM2 worker {worker.worker_id} exited with code {worker.process.exitcode}. Restarting."
+            )
+            if worker.current_task is not None:
+                with self._lock:
+                    self._cancelled.discard(worker.current_task)
+                self._resolve(
+                    worker.current_task,
+                    error=HTTPException(status_code=503, detail="SAM2 worker exited during inference"),
+                )
+            self._requeue(worker)
+            worker.restarts += 1
+            self._spawn(worker)
+
+    def _requeue(self, worker: WorkerState) -> None:
+        # The dead worker may have taken a task off its queue without reporting it as started,
+        # and the queue cannot say which. The replacement gets a fresh queue holding every task
+        # still assigned to this worker, so none is lost or run twice.
+        old_tasks = worker.tasks
+        with self._lock:
+            worker.tasks = self._ctx.Queue()
+            for task_id, (worker_id, task) in sorted(self._queued.items()):
+                if worker_id != worker.worker_id:
+                    continue
+                if task_id in self._pending:
+                    worker.tasks.put(task)
+                else:
+                    del self._queued[task_id]
+        old_tasks.cancel_join_thread()
+        old_tasks.close()
+
+    def shutdown(self) -> None:
+        self._stopping = True
+        for worker in self._workers:
+            worker.tasks.put(None)
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout=5.0)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+    def stats(self) -> dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            pending = len(self._pending)
+        workers = []
+        for worker in self._workers:
+            busy_s = worker.busy_s
+            if worker.current_task is not None:
+                busy_s += time.perf_counter() - worker.task_started_at
+            workers.append(
+                {
+                    "worker": worker.worker_id,
+                    "pid": worker.process.pid if worker.process is not None else None,
+                    "cpus": worker.cpus,
+                    "ready": worker.ready,
+                    "busy": worker.current_task is not None,
+                    "completed": worker.completed,
+                    "failed": worker.failed,
+                    "restarts": worker.restarts,
+                    "utilization": round(busy_s / max(now - worker.started_at, 1e-9), 3),
+                    "memory": process_memory(worker.process.pid) if worker.process is not None else None,
+                }
+            )
+        busy = sum(1 for w in workers if w["busy"])
+        front_end = process_memory(os.getpid())
+        samples = [front_end, *(w["memory"] for w in workers)]
+        known = [m for m in samples if m is not None]
+        return {
+            "count": len(workers),
+            "queued": max(0, pending - busy),
+            "in_flight": pending,
+            "shared_weights": self.shared_model is not None,
+            "workers": workers,
+            "memory": {
+                "front_end": front_end,
+                # Summed RSS counts shared pages once per process; summed PSS is the real footprint.
+                "total_rss_mb": round(sum(m["rss_mb"] for m in known), 1) if known else None,
+                "total_pss_mb": round(sum(m["pss_mb"] for m in known), 1) if known else None,
+            },
+        }
+
+
+class ModelLoader:
+    stages = (
+        "starting",
+        "importing torch",
+        "importing sam2",
+        "resolving config",
+        "building model",
+        "warming up",
+        "ready",
+    )
+
+    def __init__(
+        self, executor: InferenceExecutor, precision: str = "fp32", worker_count: int = 0
+    ) -> None:
+        self.executor = executor
+        self.precision = precision
+        self.worker_count = worker_count
+        self.pool: WorkerPool | None = None
+        self.batcher: EncoderBatcher | None = None
+        batch_window_ms = env_float("SAM2_BATCH_WINDOW_MS", 10.0)
+        if batch_window_ms > 0 and worker_count == 0:
+            self.batcher = EncoderBatcher(
+                executor, batch_window_ms / 1000.0, max(1, env_int("SAM2_BATCH_MAX", 4))
+            )
+        self.state = "loading"
+        self.stage = self.stages[0]
+        self.error: str | None = None
+        self.started_at = time.time()
+        self.ready_at: float | None = None
+        self.registry: ModelRegistry | None = None
+        self.caches: Sam2Caches | None = None
+        self.calibration: dict[str, Any] | None = None
+        self.phases: dict[str, float] = {}
+        self.startup: dict[str, Any] | None = None
+        self._stage_started = time.perf_counter()
+        self._done = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self.started_at = time.time()
+            self._stage_started = time.perf_counter()
+            self._thread = threading.Thread(target=self._load, name="sam2-loader", daemon=True)
+            self._thread.start()
+
+    def _enter(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.phases[self.stage] = round(now - self._stage_started, 3)
+        self._stage_started = now
+        self.stage = stage
+        print(f"[INFO] SAM2 loader: {stage} ({time.time() - self.started_at:.1f}s)")
+
+    def _load(self) -> None:
+        try:
+            self._enter("importing torch")
+            try:
+                import torch  # noqa: F401
+            except Exception as exc:
+                raise RuntimeError(
+                    "PyTorch is required. Install torch before running this server."
+                ) from exc
+
+            self._enter("importing sam2")
+            try:
+                import torchvision.ops.boxes  # noqa: F401
+                from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator  # noqa: F401
+                from sam2.build_sam import build_sam2  # noqa: F401
+            except Exception as exc:
+                raise RuntimeError(
+                    "SAM2 imports failed. Install SAM2 from source in this environment."
+                ) from exc
+
+            self._enter("resolving config")
+            variants, default_name = resolve_model_variants()
+            registry = ModelRegistry(
+                variants, default_name, env_megabytes("SAM2_MODEL_MEMORY_MB", 2048)
+            )
+
+            self._enter("building model")
+            default_model: LoadedModel | None = None
+            if self.worker_count > 0:
+                self.caches = build_caches(variants[default_name].device)
+                self.registry = registry
+                shared_model = None
+                if env_flag("SAM2_SHARED_WEIGHTS", False):
+                    shared_model = share_model_weights(registry, default_name)
+                default_model = shared_model
+                self.pool = WorkerPool(self.worker_count, self.precision, shared_model)
+                self.pool.start()
+                self.pool.wait_ready()
+                self.calibration = self.pool.calibration
+            else:
+                default_model = registry.get(default_name)
+                self.caches = build_caches(default_model.cfg.device)
+                self.registry = registry
+                warn_if_bf16_emulated(self.precision, default_model.cfg.device)
+
+                warmup = warmup_settings()
+                if warmup is not None:
+                    self._enter("warming up")
+                    # On an inference slot, so the cost model reflects its thread budget.
+                    self.calibration = self.executor.run(
+                        warmup_model, default_name, default_model, self.caches, *warmup
+                    )
+
+            self.ready_at = time.time()
+            self.state = "ready"
+            self._enter("ready")
+            self.startup = self._startup_summary(default_model)
+            parts = [f"{key[:-2]} {value:.2f}s" for key, value in self.startup.items() if key.endswith("_s")]
+            print(f"[INFO] SAM2 startup: {', '.join(parts)} (weights from {self.startup['model_source']})")
+        except Exception as exc:
+            self.error = str(exc)
+            self.state = "failed"
+            print(f"[ERROR] SAM2 model failed to load: {exc}")
+        finally:
+            self._done.set()
+
+    def _startup_summary(self, default_model: LoadedModel | None) -> dict[str, Any]:
+        # "build" is config resolution plus module graph construction, "load" is reading the
+        # weights from the checkpoint or the snapshot. With private worker models both happen
+        # in the workers and are reported together as "workers".
+        phases = self.phases
+        summary: dict[str, Any] = {
+            "import_s": round(phases.get("importing torch", 0.0) + phases.get("importing sam2", 0.0), 3)
+        }
+        timings = default_model.timings if default_model is not None else None
+        if timings is not None:
+            summary["build_s"] = round(phases.get("resolving config", 0.0) + timings["build_s"], 3)
+            summary["load_s"] = timings["load_s"]
+            if "snapshot_save_s" in timings:
+                summary["snapshot_save_s"] = timings["snapshot_save_s"]
+            if self.pool is not None:
+                summary["workers_s"] = round(
+                    phases.get("building model", 0.0) - timings["build_s"] - timings["load_s"], 3
+                )
+        else:
+            summary["build_s"] = phases.get("resolving config", 0.0)
+            summary["workers_s"] = phases.get("building model", 0.0)
+        summary["warmup_s"] = phases.get("warming up", 0.0)
+        summary["total_s"] = round(sum(phases.values()), 3)
+        summary["model_source"] = default_model.source if default_model is not None else "workers"
+        return summary
+
+    def infer(
+        self,
+        model_cfg: Sam2Config,
+        rgb: np.ndarray,
+        req: SegmentRequest,
+        inference_id: str,
+        precision: str,
+        control: RunControl | None = None,
+    ) -> list[dict[str, Any]]:
+        if self.pool is not None:
+            # Workers do not report progress back, so the whole run shows as one stage.
+            if control is not None:
+                control.report("running on worker", 0.05)
+            return self.pool.infer(model_cfg, rgb, req, inference_id, precision, control)
+        features = None
+        if self.batcher is not None and needs_encoder_pass(self.caches, rgb, req, inference_id):
+            if control is not None:
+                control.checkpoint()
+                control.report("encoding image", 0.05)
+            features = self.batcher.encode(
+                self.registry.get(model_cfg.name), precision, rgb, control
+            )
+        proposals = self.executor.run(
+            run_inference,
+            self.registry,
+            model_cfg,
+            rgb,
+            req,
+            self.caches,
+            inference_id,
+            precision,
+            features,
+            control,
+        )
+        return proposal_masks(proposals)
+
+    def shutdown(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def require_ready(self, wait_seconds: float) -> None:
+        self._done.wait(max(0.0, wait_seconds))
+        if self.state == "ready":
+            return
+        if self.state == "failed":
+            raise HTTPException(status_code=503, detail=f"SAM2 model failed to load: {self.error}")
+        raise HTTPException(
+            status_code=503,
+            detail=f"SAM2 model is still loading ({self.stage})",
+            headers={"Retry-After": "5"},
+        )
+
+    def status(self) -> dict[str, Any]:
+        finished = self.ready_at if self.ready_at is not None else time.time()
+        return {
+            "state": self.state,
+            "stage": self.stage,
+            "progress": round(self.stages.index(self.stage) / (len(self.stages) - 1), 3),
+            "elapsed_s": round(finished - self.started_at, 2),
+            "error": self.error,
+            "phases": self.phases,
+            "startup": self.startup,
+        }
+
+
+def response_payload(response: Response) -> dict[str, Any]:
+    # JSON view of a segment or parts response, for APIs that wrap results in their own JSON.
+    if response.media_type == SEGMENT_FORMATS["png"]:
+        mask = base64.b64encode(response.body).decode("ascii")
+        return {"mask": f"data:image/png;base64,{mask}"}
+    if response.media_type == SEGMENT_FORMATS["packbits"]:
+        return {"packbits": base64.b64encode(response.body).decode("ascii")}
+    return json.loads(response.body)
+
+
+@dataclass(eq=False)
+class Job:
+    id: str
+    kind: str
+    control: RunControl
+    created_at: float
+    status: str = "queued"
+    started_at: float | None = None
+    finished_at: float | None = None
+    response: Response | None = None
+    error: dict[str, Any] | None = None
+    future: Future[Any] | None = None
+
+
+class JobStore:
+    # Background segment/parts runs for clients that poll instead of holding a request open.
+    # Finished jobs keep their result for ttl_s so an aborted client can pick it up later.
+    def __init__(self, ttl_s: float, max_workers: int) -> None:
+        self.ttl_s = ttl_s
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sam2-job")
+
+    def submit(self, kind: str, control: RunControl, run: Callable[[RunControl], Response]) -> Job:
+        self._purge()
+        job = Job(id=uuid.uuid4().hex, kind=kind, control=control, created_at=time.time())
+        with self._lock:
+            self._jobs[job.id] = job
+        job.future = self._pool.submit(self._execute, job, run)
+        return job
+
+    def _execute(self, job: Job, run: Callable[[RunControl], Response]) -> None:
+        with self._lock:
+            if job.status != "queued":
+                return
+            job.status = "running"
+            job.started_at = time.time()
+        try:
+            response = run(job.control)
+        except HTTPException as exc:
+            self._finish(job, "failed", error={"status_code": exc.status_code, "detail": exc.detail})
+        except Exception as exc:
+            self._finish(job, "failed", error={"status_code": 500, "detail": str(exc)})
+        else:
+            job.control.report("done", 1.0)
+            self._finish(job, "done", response=response)
+
+    def _finish(
+        self,
+        job: Job,
+        status: str,
+        response: Response | None = None,
+        error: dict[str, Any] | None = None,
+    ) -> None:
+        with self._lock:
+            if job.status == "cancelled":
+                return
+            job.status = status
+            job.response = response
+            job.error = error
+            job.finished_at = time.time()
+
+    def get(self, job_id: str) -> Job:
+        self._purge()
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired job {job_id}")
+        return job
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        with self._lock:
+            if job.status in ("queued", "running"):
+                job.status = "cancelled"
+                job.finished_at = time.time()
+                # A running job stops at its next checkpoint.
+                job.control.cancel("job cancelled")
+                if job.future is not None:
+                    job.future.cancel()
+            else:
+                # Deleting a finished job releases its result right away.
+                self._jobs.pop(job_id, None)
+        return job
+
+    def _purge(self) -> None:
+        cutoff = time.time() - self.ttl_s
+        with self._lock:
+            expired = [
+                job_id
+                for job_id, job in self._jobs.items()
+                if job.finished_at is not None and job.finished_at < cutoff
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def describe(self, job: Job, include_result: bool = False) -> dict[str, Any]:
+        payload: dict[str, Any] = {
+            "id": job.id,
+            "kind": job.kind,
+            "status": job.status,
+            "stage": job.control.stage,
+            "progress": round(job.control.progress, 3),
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "expires_at": job.finished_at + self.ttl_s if job.finished_at is not None else None,
+            "error": job.error,
+        }
+        if include_result and job.status == "done" and job.response is not None:
+            payload["cache"] = job.response.headers.get("X-SAM2-Cache")
+            payload["result"] = response_payload(job.response)
+        return payload
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            counts: dict[str, int] = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {"ttl_s": self.ttl_s, **counts}
+
+
+async def run_until_disconnected(
+    request: Request, control: RunControl, run: Callable[[RunControl], Response]
+) -> Response:
+    # Runs a handler on the threadpool while watching the connection. When the client goes away,
+    # for example the app's AbortController firing, the run stops at its next checkpoint instead
+    # of keeping an inference slot busy for nobody.
+    task = asyncio.ensure_future(run_in_threadpool(run, control))
+    while not task.done():
+        await asyncio.wait({task}, timeout=CANCEL_POLL_S)
+        if not task.done() and control.cancel_reason is None and await request.is_disconnected():
+            print("[INFO] Client disconnected, stopping SAM2 run")
+            control.cancel("client disconnected")
+    return task.result()
+
+
+def sse_event(event: str, data: dict[str, Any] | str) -> str:
+    payload = data if isinstance(data, str) else json.dumps(data, separators=(",", ":"))
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+async def stream_run(control: RunControl, run: Callable[[RunControl], Response]) -> AsyncIterator[str]:
+    # Server-sent events for one run: every progress report and partial result as it happens,
+    # then a final "result" or "error" event. Closing the stream cancels the run.
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue[tuple[str, dict[str, Any]]] = asyncio.Queue()
+    control.listener = lambda event, data: loop.call_soon_threadsafe(events.put_nowait, (event, data))
+    task = asyncio.ensure_future(run_in_threadpool(run, control))
+    try:
+        while not task.done():
+            getter = asyncio.ensure_future(events.get())
+            await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield sse_event(*getter.result())
+            else:
+                getter.cancel()
+        while not events.empty():
+            yield sse_event(*events.get_nowait())
+        try:
+            response = task.result()
+        except HTTPException as exc:
+            yield sse_event("error", {"status_code": exc.status_code, "detail": exc.detail})
+        except Exception as exc:
+            yield sse_event("error", {"status_code": 500, "detail": f"SAM2 inference failed: {exc}"})
+        else:
+            yield sse_event("result", bytes(response.body).decode("utf-8"))
+    finally:
+        if not task.done():
+            print("[INFO] Event stream closed, stopping SAM2 run")
+            control.cancel("client disconnected")
+
+
+def request_validation_error(exc: ValidationError, source: str) -> RequestValidationError:
+    # Same 422 shape FastAPI produces for models it validates itself.
+    return RequestValidationError([{**error, "loc": (source, *error["loc"])} for error in exc.errors()])
+
+
+async def read_frames_form(
+    request: Request, model: type[SegmentRequest], max_frames: int
+) -> tuple[SegmentRequest, list[tuple[str, bytes]]]:
+    # Multipart batch body: every file part is one frame, in order, and the plain fields are the
+    # request parameters shared by all frames.
+    form = await request.form(max_files=max_frames, max_fields=64)
+    frames: list[tuple[str, bytes]] = []
+    params: dict[str, str] = {}
+    for key, value in form.multi_items():
+        if isinstance(value, str):
+            params[key] = value
+        else:
+            frames.append((value.filename or f"frame-{len(frames)}", await value.read()))
+    if not frames:
+        raise HTTPException(status_code=400, detail="Request has no image files")
+    try:
+        req = model(**{**params, "image": ""})
+    except ValidationError as exc:
+        raise request_validation_error(exc, "body") from exc
+    return req, frames
+
+
+async def read_image_request(
+    request: Request, model: type[SegmentRequest]
+) -> tuple[SegmentRequest, bytes]:
+    # One image in any of three encodings: the JSON body with a data URL, raw image bytes with
+    # the parameters in the query string, or a multipart upload with them as form fields. The raw
+    # and multipart forms skip base64 and hand the request buffer straight to the decoder.
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type == "multipart/form-data":
+        req, frames = await read_frames_form(request, model, max_frames=1)
+        return req, frames[0][1]
+    if content_type == "application/octet-stream" or content_type.startswith("image/"):
+        body = await request.body()
+        if not body:
+            raise HTTPException(status_code=400, detail="Request body is empty")
+        try:
+            req = model(**{**request.query_params, "image": ""})
+        except ValidationError as exc:
+            raise request_validation_error(exc, "query") from exc
+        return req, body
+    if content_type not in ("", "application/json"):
+        raise HTTPException(status_code=415, detail=f"Unsupported content type '{content_type}'")
+    try:
+        req = model.model_validate_json(await request.body())
+    except ValidationError as exc:
+        raise request_validation_error(exc, "body") from exc
+    return req, await run_in_threadpool(parse_data_url, req.image)
+
+
+async def stream_frames(
+    frames: list[tuple[str, bytes]],
+    deadline: float | None,
+    run: Callable[[bytes, RunControl], Response],
+    in_flight: int,
+) -> AsyncIterator[str]:
+    # One NDJSON line per frame in the order frames finish; "index" ties a line to its frame.
+    # Running in_flight frames at once lets the encoder batcher and the inference slots work on
+    # several frames together. Closing the stream cancels the frames that are still running.
+    slots = asyncio.Semaphore(in_flight)
+    controls = [RunControl(deadline) for _ in frames]
+
+    async def run_frame(index: int) -> dict[str, Any]:
+        name, image_bytes = frames[index]
+        head: dict[str, Any] = {"index": index, "name": name}
+        async with slots:
+            try:
+                response = await run_in_threadpool(run, image_bytes, controls[index])
+            except HTTPException as exc:
+                return {**head, "ok": False, "status_code": exc.status_code, "detail": exc.detail}
+            except Exception as exc:
+                return {**head, "ok": False, "status_code": 500, "detail": f"SAM2 inference failed: {exc}"}
+        return {**head, "ok": True, "cache": response.headers.get("X-SAM2-Cache"), **response_payload(response)}
+
+    tasks = [asyncio.ensure_future(run_frame(index)) for index in range(len(frames))]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield json.dumps(await finished, separators=(",", ":")) + "\n"
+    finally:
+        unfinished = sum(1 for task in tasks if not task.done())
+        if unfinished:
+            print(f"[INFO] Batch stream closed, stopping {unfinished} unfinished frame(s)")
+            for control in controls:
+                control.cancel("client disconnected")
+            for task in tasks:
+                task.cancel()
+
 
 def create_app() -> FastAPI:
-    app = FastAPI(title="Local SAM2 Segmentation Server", version="1.0.0")
+    precision = os.environ.get("SAM2_PRECISION", "fp32").strip().lower() or "fp32"
+    if precision not in PRECISIONS:
+        print(f"[WARN] Unknown SAM2_PRECISION '{precision}'. Falling back to fp32.")
+        precision = "fp32"
+    executor = build_inference_executor()
+    jobs = JobStore(env_float("SAM2_JOB_TTL_SECONDS", 900.0), max(1, env_int("SAM2_JOB_WORKERS", 4)))
+    loader = ModelLoader(executor, precision, max(0, env_int("SAM2_WORKERS", 0)))
+    # Requests that arrive while the model loads wait this long before getting a 503.
+    load_wait_seconds = env_float("SAM2_LOAD_WAIT_SECONDS", 30.0)
+    max_batch_frames = max(1, env_int("SAM2_BATCH_MAX_FRAMES", 256))
+    frames_in_flight = max(1, env_int("SAM2_BATCH_FRAMES_IN_FLIGHT", 4))
+
+    @asynccontextmanager
+    async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+        loader.start()
+        yield
+        jobs.shutdown()
+        loader.shutdown()
+        executor.shutdown()
+
+    app = FastAPI(title="Local SAM2 Segmentation Server", version=SERVER_VERSION, lifespan=lifespan)
 
     app.add_middleware(
         CORSMiddleware,
@@ -665,41 +3441,128 @@ def create_app() -> FastAPI:
         allow_headers=["*"],
     )
 
-    cfg = resolve_sam2_config()
-    model = build_sam2(cfg.config_path, cfg.checkpoint_path, device=cfg.device)
-
+    # The probes run on the event loop rather than the threadpool: their work is cheap, and
+    # queued inference requests can hold every threadpool token exactly when they are needed.
     @app.get("/health")
-    def health() -> JSONResponse:
-        return JSONResponse(
-            {
-                "ok": True,
-                "device": cfg.device,
-                "checkpoint": cfg.checkpoint_path,
-                "config": cfg.config_path,
+    async def health() -> JSONResponse:
+        payload: dict[str, Any] = {
+            "ok": True,
+            "model": loader.status(),
+            "inference": executor.stats(),
+            "encoder_batching": loader.batcher.stats() if loader.batcher is not None else None,
+            "jobs": jobs.stats(),
+        }
+        if loader.pool is not None:
+            payload["workers"] = loader.pool.stats()
+        registry, caches = loader.registry, loader.caches
+        if registry is not None and caches is not None:
+            cfg = registry.variants[registry.default_name]
+            payload.update(
+                {
+                    "device": cfg.device,
+                    "checkpoint": cfg.checkpoint_path,
+                    "config": cfg.config_path,
+                    "precision": loader.precision,
+                    "bf16_native": cfg.device != "cpu" or cpu_bf16_supported(),
+                    "models": registry.stats(),
+                    "embedding_cache": caches.embeddings.stats(),
+                    "proposal_cache": caches.proposals.stats(),
+                    "result_cache": caches.results.stats(),
+                    "disk_cache": caches.disk.stats() if caches.disk is not None else None,
+                }
+            )
+        return JSONResponse(payload)
+
+    @app.get("/ready")
+    async def ready() -> JSONResponse:
+        status = loader.status()
+        if status["state"] == "ready":
+            return JSONResponse({"ready": True, **status})
+        headers = {"Retry-After": "5"} if status["state"] == "loading" else None
+        return JSONResponse({"ready": False, **status}, status_code=503, headers=headers)
+
+    @app.get("/models")
+    def models() -> JSONResponse:
+        loader.require_ready(0.0)
+        return JSONResponse(loader.registry.stats())
+
+    @app.get("/calibration")
+    def calibration(
+        width: int | None = None,
+        height: int | None = None,
+        points_per_side: int = 32,
+        use_m2m: bool = True,
+    ) -> JSONResponse:
+        loader.require_ready(0.0)
+        if loader.calibration is None:
+            return JSONResponse({"calibrated": False})
+        payload: dict[str, Any] = {"calibrated": True, **loader.calibration}
+        if width is not None and height is not None:
+            estimate_ms = estimate_request_ms(
+                loader.calibration, width, height, points_per_side, use_m2m
+            )
+            payload["estimate"] = {
+                "width": width,
+                "height": height,
+                "points_per_side": points_per_side,
+                "use_m2m": use_m2m,
+                "estimate_ms": round(estimate_ms, 1),
+                "suggested_timeout_ms": int(estimate_ms * 2 + 2000),
             }
-        )
-
-    @app.post("/sam2/segment")
-    def segment(req: SegmentRequest) -> Response:
-        image = image_from_data_url(req.image)
+        return JSONResponse(payload)
+
+    def run_segment(req: SegmentRequest, image_bytes: bytes, control: RunControl | None = None) -> Response:
+        req = req.model_copy(update={"format": req.format or "png"})
+        loader.require_ready(load_wait_seconds)
+        registry, caches = loader.registry, loader.caches
+        model_cfg = registry.resolve(req.model)
+        precision = resolve_precision(req.precision, loader.precision, model_cfg)
+        inference_id = inference_identity(model_identity(model_cfg), precision)
+        cache_key = result_cache_key("segment", image_bytes, req, inference_id)
+        cached = cached_response(caches.results, cache_key)
+        if cached is not None:
+            return cached
+
+        image = image_from_bytes(image_bytes)
         rgb = pil_to_rgb_numpy(image)
         h, w = rgb.shape[0], rgb.shape[1]
 
-        generator = build_generator(model, req)
-        masks = generator.generate(rgb)
+        masks = loader.infer(model_cfg, rgb, req, inference_id, precision, control)
+        if control is not None:
+            control.checkpoint()
+            control.report("post-processing", 0.85)
         mask_luma = combine_masks(masks, h, w)
-        return png_response_from_mask(mask_luma)
-
-    @app.post("/sam2/parts")
-    def parts(req: PartsRequest) -> JSONResponse:
-        image = image_from_data_url(req.image)
+        return remember_response(caches.results, cache_key, mask_response(mask_luma, req.format))
+
+    def run_parts(req: PartsRequest, image_bytes: bytes, control: RunControl | None = None) -> Response:
+        req = req.model_copy(update={"format": req.format or "json"})
+        loader.require_ready(load_wait_seconds)
+        registry, caches = loader.registry, loader.caches
+        model_cfg = registry.resolve(req.model)
+        precision = resolve_precision(req.precision, loader.precision, model_cfg)
+        inference_id = inference_identity(model_identity(model_cfg), precision)
+        cache_key = result_cache_key("parts", image_bytes, req, inference_id)
+        cached = cached_response(caches.results, cache_key)
+        if cached is not None:
+            return cached
+
+        image = image_from_bytes(image_bytes)
         rgb = pil_to_rgb_numpy(image)
         h, w = rgb.shape[0], rgb.shape[1]
         alpha_mask = alpha_opaque_mask(image)
         opaque_mask = estimate_foreground_mask_from_edges(image, alpha_mask)
-
-        generator = build_generator(model, req)
-        masks = generator.generate(rgb)
+        if control is not None:
+            control.report("image decoded", 0.02, width=w, height=h)
+
+        masks = loader.infer(model_cfg, rgb, req, inference_id, precision, control)
+        if control is not None:
+            control.checkpoint()
+            if control.listener is not None:
+                # The union of the raw masks is close to the final character mask and costs one
+                # PNG encode, so streaming clients get something to show before post-processing.
+                coarse = Image.fromarray(combine_masks(masks, h, w), mode="L")
+                control.emit("coarse", {"mask": data_url_from_pil_png(coarse), "masks": len(masks)})
+            control.report("post-processing", 0.85)
 
         character_mask, part_masks, labeled_regions = build_part_masks(
             mask_items=masks,
@@ -708,12 +3571,39 @@ def create_app() -> FastAPI:
             max_regions=req.max_regions,
             source_opaque_mask=opaque_mask,
         )
+        if req.format == "labelmap":
+            # Region metadata plus one label map instead of two full-size RGBA preview PNGs.
+            _, parts_data = build_parts_preview(image, character_mask, part_masks, render=False)
+            _, regions_data = build_regions_preview(image, character_mask, labeled_regions, render=False)
+            response = JSONResponse(
+                {
+                    "ok": True,
+                    "image_width": w,
+                    "image_height": h,
+                    "total_parts": len(parts_data),
+                    "labelmap": {
+                        "encoding": "zlib",
+                        "dtype": "uint8",
+                        "data": encode_label_map(labeled_regions, h, w),
+                    },
+                    "parts": parts_data,
+                    "regions": regions_data,
+                },
+                media_type=PARTS_FORMATS["labelmap"],
+            )
+            return remember_response(caches.results, cache_key, response)
+
+        if control is not None:
+            control.checkpoint()
+            control.report("rendering previews", 0.92)
         preview_data_url, parts_data = build_parts_preview(image, character_mask, part_masks)
+        if control is not None:
+            control.checkpoint()
         regions_preview_data_url, regions_data = build_regions_preview(
             image, character_mask, labeled_regions
         )
 
-        return JSONResponse(
+        response = JSONResponse(
             {
                 "ok": True,
                 "image_width": w,
@@ -725,11 +3615,116 @@ def create_app() -> FastAPI:
                 "regions": regions_data,
             }
         )
+        return remember_response(caches.results, cache_key, response)
 
-    return app
+    @app.post("/sam2/segment")
+    async def segment(request: Request) -> Response:
+        req, image_bytes = await read_image_request(request, SegmentRequest)
+        accept = request.headers.get("accept", "")
+        req = req.model_copy(update={"format": negotiate_format(req.format, accept, SEGMENT_FORMATS)})
+        return await run_until_disconnected(
+            request,
+            RunControl.for_request(req),
+            lambda control: run_segment(req, image_bytes, control),
+        )
+
+    @app.post("/sam2/parts")
+    async def parts(request: Request) -> Response:
+        req, image_bytes = await read_image_request(request, PartsRequest)
+        accept = request.headers.get("accept", "")
+        req = req.model_copy(update={"format": negotiate_format(req.format, accept, PARTS_FORMATS)})
+        return await run_until_disconnected(
+            request,
+            RunControl.for_request(req),
+            lambda control: run_parts(req, image_bytes, control),
+        )
 
+    @app.post("/sam2/parts/stream")
+    async def parts_stream(request: Request) -> StreamingResponse:
+        req, image_bytes = await read_image_request(request, PartsRequest)
+        return StreamingResponse(
+            stream_run(
+                RunControl.for_request(req),
+                lambda control: run_parts(req, image_bytes, control),
+            ),
+            media_type="text/event-stream",
+            # Keep reverse proxies from buffering the events.
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
-app = create_app()
+    def check_batch(req: SegmentRequest) -> None:
+        # Fail the whole batch up front instead of once per frame.
+        loader.require_ready(load_wait_seconds)
+        model_cfg = loader.registry.resolve(req.model)
+        resolve_precision(req.precision, loader.precision, model_cfg)
+
+    def batch_response(
+        frames: list[tuple[str, bytes]],
+        req: SegmentRequest,
+        run: Callable[[bytes, RunControl], Response],
+    ) -> StreamingResponse:
+        return StreamingResponse(
+            stream_frames(frames, RunControl.for_request(req).deadline, run, frames_in_flight),
+            media_type="application/x-ndjson",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+                "X-SAM2-Frames": str(len(frames)),
+            },
+        )
+
+    @app.post("/sam2/segment/batch")
+    async def segment_batch(request: Request) -> StreamingResponse:
+        req, frames = await read_frames_form(request, SegmentRequest, max_batch_frames)
+        await run_in_threadpool(check_batch, req)
+        return batch_response(
+            frames, req, lambda image_bytes, control: run_segment(req, image_bytes, control)
+        )
+
+    @app.post("/sam2/parts/batch")
+    async def parts_batch(request: Request) -> StreamingResponse:
+        req, frames = await read_frames_form(request, PartsRequest, max_batch_frames)
+        await run_in_threadpool(check_batch, req)
+        return batch_response(
+            frames, req, lambda image_bytes, control: run_parts(req, image_bytes, control)
+        )
+
+    @app.post("/jobs", status_code=202)
+    async def submit_job(request: Request) -> JSONResponse:
+        if loader.state == "failed":
+            loader.require_ready(0.0)
+        req, image_bytes = await read_image_request(request, JobRequest)
+        target, run = (SegmentRequest, run_segment) if req.kind == "segment" else (PartsRequest, run_parts)
+        try:
+            # Also checks that the format fits the kind.
+            run_req = target(**req.model_dump(include=set(target.model_fields)))
+        except ValidationError as exc:
+            raise request_validation_error(exc, "body") from exc
+        job = jobs.submit(
+            req.kind,
+            RunControl.for_request(req),
+            lambda control: run(run_req, image_bytes, control),
+        )
+        return JSONResponse(
+            jobs.describe(job), status_code=202, headers={"Location": f"/jobs/{job.id}"}
+        )
+
+    @app.get("/jobs/{job_id}")
+    def get_job(job_id: str) -> JSONResponse:
+        return JSONResponse(jobs.describe(jobs.get(job_id), include_result=True))
+
+    @app.get("/jobs/{job_id}/result")
+    def get_job_result(job_id: str) -> Response:
+        job = jobs.get(job_id)
+        if job.status != "done" or job.response is None:
+            raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+        return job.response
+
+    @app.delete("/jobs/{job_id}")
+    def delete_job(job_id: str) -> JSONResponse:
+        return JSONResponse(jobs.describe(jobs.cancel(job_id)))
+
+    return app
 
 
 if __name__ == "__main__":
@@ -737,4 +3732,5 @@ if __name__ == "__main__":
 
     host = os.environ.get("SAM2_HOST", "127.0.0.1")
     port = int(os.environ.get("SAM2_PORT", "8765"))
-    uvicorn.run("server:app", host=host, port=port, reload=False)
+    # Factory mode: worker processes re-import this module and must not build an app of their own.
+    uvicorn.run("server:create_app", factory=True, host=host, port=port, reload=False)
@@ -5,7 +5,8 @@ set "SCRIPT_DIR=%~dp0"
 set "PYTHON_EXE=%SCRIPT_DIR%.venv\Scripts\python.exe"
 set "SERVER_PY=%SCRIPT_DIR%server.py"
 set "HEALTH_URL=http://127.0.0.1:8765/health"
-set "READY_TIMEOUT=35"
+set "READY_URL=http://127.0.0.1:8765/ready"
+if "%SAM2_READY_TIMEOUT%"=="" (set "READY_TIMEOUT=180") else (set "READY_TIMEOUT=%SAM2_READY_TIMEOUT%")
 set "LOG_DIR=%SCRIPT_DIR%logs"
 set "LOG_FILE=%LOG_DIR%\sam2-server.log"
 set "LOG_ERR_FILE=%LOG_DIR%\sam2-server.err.log"
@@ -63,14 +64,14 @@ if errorlevel 1 (
 powershell -NoProfile -ExecutionPolicy Bypass -Command ^
   "$deadline = (Get-Date).AddSeconds(%READY_TIMEOUT%); " ^
   "while ((Get-Date) -lt $deadline) { " ^
-  "  try { $r = Invoke-WebRequest -UseBasicParsing '%HEALTH_URL%' -TimeoutSec 2; if ($r.StatusCode -eq 200) { exit 0 } } catch { }; " ^
+  "  try { $r = Invoke-WebRequest -UseBasicParsing '%READY_URL%' -TimeoutSec 2; if ($r.StatusCode -eq 200) { exit 0 } } catch { }; " ^
   "  Start-Sleep -Milliseconds 750; " ^
   "}; exit 1"
 if errorlevel 1 (
-  echo [WARN] Local SAM2 server did not become ready within %READY_TIMEOUT%s.
+  echo [WARN] Local SAM2 model did not finish loading within %READY_TIMEOUT%s.
   echo [WARN] Check log file: %LOG_FILE%
 ) else (
-  echo [INFO] Local SAM2 server is ready.
+  echo [INFO] Local SAM2 server is ready, model loaded.
 )
 
 endlocal